@@ -299,8 +299,8 @@ submit() {
     fi
 
     git add -A
-    git diff --cached > model.patch
-    echo "<<SUBMISSION||"
-    cat model.patch
-    echo "||SUBMISSION>>"
+    # The patch is retrieved from the artifacts directory, only a reference is printed
+    mkdir -p /root/artifacts
+    git diff --cached > /root/artifacts/model.patch
+    echo "<<SUBMISSION||artifact:model.patch||SUBMISSION>>"
 }
\ No newline at end of file
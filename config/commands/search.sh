@@ -1,6 +1,7 @@
 # @yaml
 # signature: search_dir <search_term> [<dir>]
 # docstring: searches for search_term in all files in dir. If dir is not provided, searches in the current directory
+# read_only: true
 # arguments:
 #   search_term:
 #     type: string
@@ -51,6 +52,7 @@ search_dir() {
 # @yaml
 # signature: search_file <search_term> [<file>]
 # docstring: searches for search_term in file. If file is not provided, searches in the current open file
+# read_only: true
 # arguments:
 #   search_term:
 #     type: string
@@ -115,6 +117,7 @@ search_file() {
 # @yaml
 # signature: find_file <file_name> [<dir>]
 # docstring: finds all files with the given name in dir. If dir is not provided, searches in the current directory
+# read_only: true
 # arguments:
 #   file_name:
 #     type: string
@@ -20,6 +20,7 @@ from swebench import (
 from swebench.harness.constants import (
     INSTALL_FAIL,
 )
+from sweagent.agent.journal import load_trajectory
 from unidiff import PatchSet
 
 
@@ -87,8 +88,9 @@ def main(predictions_path, log_dir, swe_bench_tasks, testbed, skip_existing, tim
 
         # Add trajectory statistics if traj_path exists
         traj_path = os.path.join(directory, f"{p[KEY_INSTANCE_ID]}.traj")
-        if os.path.exists(traj_path):
-            traj_data = json.load(open(traj_path, "r"))
+        journal_path = os.path.join(directory, f"{p[KEY_INSTANCE_ID]}.journal")
+        if os.path.exists(traj_path) or os.path.exists(journal_path):
+            traj_data = load_trajectory(traj_path)
             scorecard["stats"]["traj_num_steps"] = len(traj_data["trajectory"])
             scorecard["stats"]["traj_action_dist"] = dict(
                 Counter(
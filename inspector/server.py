@@ -8,6 +8,7 @@ import yaml
 from pathlib import Path
 from argparse import ArgumentParser
 from functools import partial
+from sweagent.agent.journal import JOURNAL_SUFFIX, load_trajectory
 
 
 def append_exit(content):
@@ -126,8 +127,7 @@ def append_results(traj_path, instance_id, content, results, results_file, score
 
 
 def load_content(file_name, gold_patches, test_patches):
-    with open(file_name) as infile:
-        content = json.load(infile)
+    content = load_trajectory(file_name)
     results_file = Path(file_name).parent / "results.json"
     results = None
     if results_file.exists():
@@ -155,6 +155,28 @@ def load_content(file_name, gold_patches, test_patches):
     return content
 
 
+def get_trajectory_files(traj_dir):
+    """All `.traj` files plus the journals of episodes that are still running"""
+    traj_files = list(Path(traj_dir).glob('**/*.traj'))
+    # The journal of a finished episode is removed right after its `.traj` file has been written
+    journals = [
+        journal for journal in Path(traj_dir).glob(f'**/*{JOURNAL_SUFFIX}')
+        if not journal.with_suffix('.traj').exists()
+    ]
+    return [*traj_files, *journals]
+
+
+def get_mod_times(files):
+    """Modification times of `files`, files that were removed in the meantime (journals) are skipped"""
+    mod_times = dict()
+    for file in files:
+        try:
+            mod_times[str(file)] = os.path.getmtime(file)
+        except FileNotFoundError:
+            pass
+    return mod_times
+
+
 def load_results(traj_path):
     results_file = Path(traj_path).parent / "results.json"
     if results_file.exists():
@@ -232,14 +254,14 @@ class Handler(http.server.SimpleHTTPRequestHandler):
         files = sorted(
             [
                 str(file.relative_to(Path(self.traj_dir))) + " " * 4 + get_status(file)
-                for file in Path(self.traj_dir).glob('**/*.traj')
+                for file in get_trajectory_files(self.traj_dir)
             ],
             key=lambda x: str(Path(self.traj_dir) / x), reverse=True
         )
         self.wfile.write(json.dumps(files).encode())
 
     def check_for_updates(self):
-        current_mod_times = {str(file): os.path.getmtime(file) for file in Path(self.traj_dir).glob('**/*.traj')}
+        current_mod_times = get_mod_times(get_trajectory_files(self.traj_dir))
         if current_mod_times != Handler.file_mod_times:
             Handler.file_mod_times = current_mod_times
             self.send_response(200)  # Send response that there's an update
@@ -0,0 +1,153 @@
+"""
+Pre-populates a local package mirror that can be passed to `run.py --package_mirror <dir>`.
+
+For every (repo, version) install spec (`MAP_VERSION_TO_INSTALL`) used by a dataset, a container is started
+from the SWE-agent image with the mirror mounted. The conda environment is created as in `SWEEnv.install_env`
+with `<dir>/conda` as package cache and all pip requirements (including the `pip:` section of environment files
+and the build requirements of the repository) are downloaded into the `<dir>/pip` wheelhouse.
+Afterwards, `--offline` runs can install the environments without network access.
+"""
+import os
+import shlex
+import subprocess
+import yaml
+
+from argparse import ArgumentParser
+from sweagent.environment.swe_env import PATH_TO_ENV_YML, PATH_TO_PACKAGE_MIRROR, PATH_TO_REQS
+from sweagent.environment.utils import get_instances
+from swebench import get_environment_yml, get_requirements, MAP_VERSION_TO_INSTALL
+
+ENV_NAME = "package_mirror"
+PATH_TO_REPO = "/root/package_mirror_repo"
+PATH_TO_PIP_REQS = "/root/package_mirror_pip_requirements.txt"
+PATH_TO_PYPROJECT = "/root/package_mirror_pyproject.toml"
+# Prints the `build-system.requires` of a pyproject.toml (pip vendors a TOML parser)
+PRINT_BUILD_REQUIRES = (
+    "import sys\n"
+    "try:\n    import tomllib\n"
+    "except ImportError:\n    from pip._vendor import tomli as tomllib\n"
+    "with open(sys.argv[1], 'rb') as f:\n"
+    "    print('\\n'.join(tomllib.load(f).get('build-system', {}).get('requires', [])))\n"
+)
+
+
+def get_specs(data_path: str, split: str):
+    """Return one task instance per (repo, version) install spec used by the dataset."""
+    specs = dict()
+    for record in get_instances(data_path, split=split):
+        key = (record["repo"], str(record["version"]))
+        if key not in specs and record["repo"] in MAP_VERSION_TO_INSTALL:
+            specs[key] = record
+    return specs
+
+
+def get_pip_requirements(environment_yml: str) -> list[str]:
+    """Return the entries of the `pip:` section of a conda environment file."""
+    requirements = list()
+    for dependency in yaml.safe_load(environment_yml).get("dependencies", []):
+        if isinstance(dependency, dict):
+            requirements.extend(dependency.get("pip", []))
+    return requirements
+
+
+def get_mirror_script(record, include_repo_dependencies: bool) -> str:
+    """Bash script that creates the conda env for `record` and downloads all pip packages into the mirror."""
+    install_configs = MAP_VERSION_TO_INSTALL[record["repo"]][str(record["version"])]
+    pip_dir = f"{PATH_TO_PACKAGE_MIRROR}/pip"
+    packages = install_configs.get("packages", "")
+    lines = [
+        "set -e",
+        "source /root/miniconda3/etc/profile.d/conda.sh",
+        f"mkdir -p {pip_dir} {PATH_TO_PACKAGE_MIRROR}/conda",
+    ]
+    if packages == "requirements.txt":
+        lines += [
+            f"conda create -n {ENV_NAME} python={install_configs['python']} -y",
+            f"cat > {PATH_TO_REQS} <<'EOF'\n{get_requirements(record)}\nEOF",
+            f"conda activate {ENV_NAME}",
+            f"pip download -d {pip_dir} -r {PATH_TO_REQS}",
+        ]
+    elif packages == "environment.yml":
+        environment_yml = get_environment_yml(record, ENV_NAME)
+        lines.append(f"cat > {PATH_TO_ENV_YML} <<'EOF'\n{environment_yml}\nEOF")
+        if install_configs.get("no_use_env", False):
+            lines += [
+                f"conda create -c conda-forge -n {ENV_NAME} python={install_configs['python']} -y",
+                f"conda env update -f {PATH_TO_ENV_YML}",
+            ]
+        else:
+            lines.append(f"conda env create --file {PATH_TO_ENV_YML}")
+        lines.append(f"conda activate {ENV_NAME}")
+        # conda installs the `pip:` section with pip, which only finds the packages offline if they are mirrored
+        pip_requirements = get_pip_requirements(environment_yml)
+        if pip_requirements:
+            pip_requirements = "\n".join(pip_requirements)
+            lines += [
+                f"cat > {PATH_TO_PIP_REQS} <<'EOF'\n{pip_requirements}\nEOF",
+                f"pip download -d {pip_dir} -r {PATH_TO_PIP_REQS}",
+            ]
+    else:
+        lines += [
+            f"conda create -n {ENV_NAME} python={install_configs['python']} {packages} -y",
+            f"conda activate {ENV_NAME}",
+        ]
+    if "pip_packages" in install_configs:
+        lines.append(f"pip download -d {pip_dir} {install_configs['pip_packages']}")
+    # Always needed by SWEEnv.reset (flake8) and by builds with isolation (setuptools, wheel)
+    lines.append(f"pip download -d {pip_dir} flake8 setuptools wheel")
+    # Builds with isolation install the build requirements of the repository (declared in pyproject.toml)
+    pyproject_url = f"https://raw.githubusercontent.com/{record['repo']}/{record['base_commit']}/pyproject.toml"
+    lines += [
+        f"if wget -q {pyproject_url} -O {PATH_TO_PYPROJECT}; then",
+        f"  python -c {shlex.quote(PRINT_BUILD_REQUIRES)} {PATH_TO_PYPROJECT} > {PATH_TO_PIP_REQS}"
+        f" || echo 'Failed to read build requirements of {record['repo']}'",
+        f"  if [ -s {PATH_TO_PIP_REQS} ]; then pip download -d {pip_dir} -r {PATH_TO_PIP_REQS}; fi",
+        "fi",
+    ]
+    install_cmd = install_configs.get("install", "")
+    if include_repo_dependencies and install_cmd.startswith("pip install"):
+        # Resolve the dependencies declared by the repository itself at the base commit
+        target = install_cmd[len("pip install"):].replace(" -e ", " ").strip()
+        lines += [
+            f"git clone https://github.com/{record['repo']}.git {PATH_TO_REPO}",
+            f"cd {PATH_TO_REPO} && git checkout {record['base_commit']}",
+            f"pip download -d {pip_dir} {target} || echo 'Failed to download dependencies of {record['repo']}'",
+        ]
+    return "\n".join(lines)
+
+
+def main(data_path: str, split: str, image_name: str, mirror_dir: str, include_repo_dependencies: bool):
+    mirror_dir = os.path.abspath(mirror_dir)
+    os.makedirs(mirror_dir, exist_ok=True)
+    specs = get_specs(data_path, split)
+    print(f"Found {len(specs)} install specs in {data_path}")
+    failed = list()
+    for (repo, version), record in specs.items():
+        print(f"Mirroring packages for {repo} {version}...")
+        command = [
+            "docker", "run", "--rm",
+            "-v", f"{mirror_dir}:{PATH_TO_PACKAGE_MIRROR}",
+            "-e", f"CONDA_PKGS_DIRS={PATH_TO_PACKAGE_MIRROR}/conda,/root/miniconda3/pkgs",
+            image_name,
+            "/bin/bash", "-l", "-c", get_mirror_script(record, include_repo_dependencies),
+        ]
+        if subprocess.run(command).returncode != 0:
+            failed.append(f"{repo} {version}")
+    if failed:
+        print(f"Failed to mirror packages for: {', '.join(failed)}")
+    print(f"Package mirror written to {mirror_dir}. Use it with: python run.py --package_mirror {shlex.quote(mirror_dir)}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--data_path", help="Path to data file or HuggingFace dataset", default="princeton-nlp/SWE-bench_Lite")
+    parser.add_argument("--split", help="Dataset split", default="dev")
+    parser.add_argument("--image_name", help="SWE-agent docker image", default="sweagent/swe-agent:latest")
+    parser.add_argument("--mirror_dir", help="Directory to write the package mirror to", required=True)
+    parser.add_argument(
+        "--include_repo_dependencies",
+        help="Also clone each repository and download the dependencies it declares (pip install targets)",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    main(**vars(args))
@@ -23,6 +23,8 @@ from sweagent import (
 from swebench import KEY_INSTANCE_ID, KEY_MODEL, KEY_PREDICTION
 from unidiff import PatchSet
 
+from sweagent.agent.journal import JOURNAL_SUFFIX, load_checkpoint, load_trajectory
+from sweagent.agent.rollouts import RolloutScorer, run_rollouts
 from sweagent.environment.utils import InvalidGithubURL, get_associated_commit_urls, get_gh_issue_data, parse_gh_issue_url
 
 handler = RichHandler(show_time=False, show_path=False)
@@ -62,6 +64,17 @@ class ScriptArguments(FlattenedAccess, FrozenSerializable):
     instance_filter: str = ".*"  # Only run instances that completely match this regex
     skip_existing: bool = True  # Skip instances with existing trajectories
     suffix: str = ""
+    traj_fsync_every: int = 0  # fsync the trajectory journal every n steps (0: leave flushing to the OS)
+    num_rollouts: int = 1  # Run this many episodes per instance concurrently (in forks of the prepared environment, in one event loop)
+    rollout_scorer: str = "AppliedPatchScorer"  # Selects the submission among the rollouts (see sweagent/agent/rollouts.py)
+    # Checkpoint the workspace with every step and resume unfinished episodes from their last checkpoint
+    # (only with a single rollout)
+    checkpoint: bool = False
+
+    def __post_init__(self):
+        if self.num_rollouts > 1 and self.agent.model.response_cache_path:
+            # All rollouts start from the same history, with cached responses they would be the same episode
+            raise ValueError("The response cache (response_cache_path) cannot be used with more than one rollout")
 
     @property
     def run_name(self):
@@ -100,6 +113,10 @@ def main(args: ScriptArguments):
             instance_id = env.data[index]["instance_id"]
             if should_skip(args, traj_dir, instance_id):
                 continue
+            resume_content = None
+            journal_path = (traj_dir / (instance_id + ".traj")).with_suffix(JOURNAL_SUFFIX)
+            if args.checkpoint and args.skip_existing and args.num_rollouts == 1 and journal_path.exists():
+                resume_content = load_checkpoint(journal_path)
             logger.info("▶️  Beginning task " + str(index))
 
             observation, info = env.reset(index)
@@ -130,13 +147,31 @@ def main(args: ScriptArguments):
                 "test_files": test_files,
                 "tests": tests
             }
-            info, trajectory = agent.run(
-                setup_args=setup_args,
-                env=env,
-                observation=observation,
-                traj_dir=traj_dir,
-                return_type="info_trajectory",
-            )
+            if args.num_rollouts > 1:
+                info, trajectory = run_rollouts(
+                    agent,
+                    env,
+                    args.num_rollouts,
+                    RolloutScorer.get(args.rollout_scorer),
+                    setup_args=setup_args,
+                    observation=observation,
+                    traj_dir=traj_dir,
+                    traj_fsync_every=args.traj_fsync_every,
+                )
+            else:
+                if resume_content is not None:
+                    logger.info(f"Resuming episode after step {len(resume_content['trajectory'])}")
+                    observation = agent.restore_checkpoint(setup_args, env, resume_content)
+                info, trajectory = agent.run(
+                    setup_args=setup_args,
+                    env=env,
+                    observation=observation,
+                    traj_dir=traj_dir,
+                    return_type="info_trajectory",
+                    resume=resume_content is not None,
+                    traj_fsync_every=args.traj_fsync_every,
+                    save_checkpoints=args.checkpoint,
+                )
             save_predictions(traj_dir, instance_id, info)
             if args.actions.open_pr and should_open_pr(args, info, token=env.token):
                 env.open_pr(args.actions, info, trajectory)
@@ -219,18 +254,30 @@ def should_skip(args, traj_dir, instance_id):
     if not args.skip_existing:
         return False
 
-    # Check if there's an existing trajectory for this instance
+    # Check if there's an existing trajectory (or journal of an unfinished episode) for this instance
     log_path = traj_dir / (instance_id + ".traj")
-    if log_path.exists():
-        with log_path.open("r") as f:
-            data = json.load(f)
+    journal_path = log_path.with_suffix(JOURNAL_SUFFIX)
+    if log_path.exists() or journal_path.exists():
+        data = load_trajectory(log_path)
         # If the trajectory has no exit status, it's incomplete and we will redo it
         exit_status = data["info"].get("exit_status", None)
         if exit_status == "early_exit" or exit_status is None:
+            if args.checkpoint and journal_path.exists() and load_checkpoint(journal_path) is not None:
+                logger.info(f"Found checkpoint of unfinished episode: {journal_path}")
+                if log_path.exists():
+                    os.remove(log_path)
+                return False
             logger.info(f"Found existing trajectory with no exit status: {log_path}")
             logger.info("Removing incomplete trajectory...")
-            os.remove(log_path)
+            for path in [log_path, journal_path]:
+                if path.exists():
+                    os.remove(path)
         else:
+            if not log_path.exists():
+                # Episode finished, but the journal was not replaced by the trajectory file
+                with log_path.open("w") as f:
+                    json.dump(data, f, indent=2)
+                os.remove(journal_path)
             logger.info(f"⏭️ Skipping existing trajectory: {log_path}")
             return True
     return False
@@ -1,12 +1,18 @@
+import copy
+import functools
+import hashlib
 import json
 import re
 import logging
+import shlex
+import threading
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from pathlib import Path
 from simple_parsing.helpers import field, FrozenSerializable, FlattenedAccess
-from sweagent.agent.commands import Command, ParseCommand
-from sweagent.agent.history_processors import HistoryProcessor
+from sweagent.agent.commands import Command, CommandLexer, CommandMatch, ParseCommand
+from sweagent.agent.history_processors import HistoryProcessor, ProcessedHistory
+from sweagent.agent.journal import TrajectoryJournal
 from sweagent.agent.models import (
     APIStats,
     ContextWindowExceededError,
@@ -15,6 +21,7 @@ from sweagent.agent.models import (
     get_model,
 )
 from sweagent.agent.parsing import ParseFunction, FormatError
+from sweagent.agent.steps import AgentRun, BlockingCall, ModelQuery, Steps, arun_steps, run_steps
 from sweagent.environment.utils import LOGGER_NAME
 from sweagent.environment.swe_env import SWEEnv
 from tenacity import RetryError
@@ -80,6 +87,19 @@ class AgentConfig(FrozenSerializable):
         "emacs",
         "nano",
     )
+    # A loop is an (action, observation) pair, or a cycle of up to `loop_max_cycle_length` pairs, that is repeated
+    # `loop_max_repeats` times in a row (0: no loop detection). The first `loop_max_corrections` loops are
+    # answered with `loop_error_template`, afterwards the episode is autosubmitted (`exit_loop`)
+    loop_max_repeats: int = 0
+    loop_max_cycle_length: int = 2
+    loop_max_corrections: int = 1
+    loop_error_template: str = (
+        "Your last {n_steps} actions repeated the same {cycle_length} action(s) with the same output. "
+        "Repeating them again will not help, please try a different approach."
+    )
+    # If True, the state command runs in the same round trip as each action (see `SWEEnv.step`) instead of
+    # as a separate command before each query
+    state_trailer: bool = False
     # Should extract environment state in a json readable form
     state_command: Command = Command(
         name="state",
@@ -178,6 +198,75 @@ class AgentArguments(FlattenedAccess, FrozenSerializable):
             object.__setattr__(model_args, "total_cost_limit", self.model.total_cost_limit)
 
 
+class ObservationCache:
+    """Episode-scoped cache of the observations of read-only commands.
+
+    Entries are only valid within a generation. The generation is bumped (and the cache cleared) by every
+    action that is not read-only, since it can change files or the shell state.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self._observations = dict()
+
+    def __contains__(self, key) -> bool:
+        return key in self._observations
+
+    def __getitem__(self, key) -> str:
+        return self._observations[key]
+
+    def __setitem__(self, key, observation: str) -> None:
+        self._observations[key] = observation
+
+    def invalidate(self) -> None:
+        self.generation += 1
+        self._observations.clear()
+
+
+class LoopDetector:
+    """Detects degenerate loops: the same (action, observation) pair, or cycle of pairs, repeated in a row."""
+
+    def __init__(self, max_repeats: int, max_cycle_length: int):
+        self.max_repeats = max_repeats
+        self.max_cycle_length = max_cycle_length
+        self.fingerprints = list()  # fingerprints of the recent (action, observation) pairs
+        self.triggers = list()  # detected loops
+
+    def add(self, action: str, observation: str) -> Optional[int]:
+        """Add a step, returns the length of the cycle if the step completes a loop (None otherwise)."""
+        if self.max_repeats <= 0:
+            return None
+        self.fingerprints.append(hash((action.strip(), observation)))
+        del self.fingerprints[:-self.max_cycle_length * self.max_repeats]
+        for cycle_length in range(1, self.max_cycle_length + 1):
+            recent = self.fingerprints[-cycle_length * self.max_repeats:]
+            if len(recent) < cycle_length * self.max_repeats:
+                break
+            if all(recent[i] == recent[i - cycle_length] for i in range(cycle_length, len(recent))):
+                # A loop has to be repeated from scratch to be detected again
+                self.fingerprints.clear()
+                return cycle_length
+        return None
+
+
+@dataclass(frozen=True)
+class PromptPrefix:
+    """System message and demonstrations at the start of the history, shared by all instances (must not be modified)."""
+    entries: tuple  # history entries
+    hash: str  # sha256 of the entries, identifies the prefix (e.g. for prompt caching)
+
+
+_prompt_prefixes = dict()  # (agent name, model, system message and demonstration settings) -> PromptPrefix
+_prompt_prefixes_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def load_demonstration_history(path: str) -> tuple:
+    """Load the history of a demonstration trajectory (cached, the entries must not be modified)."""
+    with open(path, "r") as f:
+        return tuple(json.load(f)["history"])
+
+
 class Agent:
     """Agent handles the behaviour of the model and how it interacts with the environment."""
 
@@ -185,6 +274,14 @@ class Agent:
         self.name = name
         self.model = get_model(args.model, args.config._commands + args.config.subroutine_types)
         self.config = args.config
+        self.model.parse_function = self.config.parse_function
+        self.repair_model = None  # model for repair queries, falls back to `model` if its repair fails
+        if args.model.repair_model_name is not None:
+            self.repair_model = get_model(
+                replace(args.model, model_name=args.model.repair_model_name, repair_model_name=None),
+                args.config._commands + args.config.subroutine_types,
+            )
+            self.repair_model.parse_function = self.config.parse_function
         self.system_args = {
             "command_docs": self.config.command_docs,
             **self.config.env_variables,
@@ -192,17 +289,45 @@ class Agent:
         self.instance_args = None
         self._parse_command_patterns()
         self.history = []
+        self.trajectory = []
         self.last_container_id = None
+        self.sub_agents = dict()  # subroutine name -> agent, reused across calls of the subroutine
+        self.checkpoint_patch_hash = None  # hash of the workspace patch of the last checkpoint in the journal
+        self.read_only_commands = {command.name for command in self.config._commands if command.read_only}
+        self.observation_cache = ObservationCache()
+        self.loop_detector = LoopDetector(self.config.loop_max_repeats, self.config.loop_max_cycle_length)
+        self._reset_local_history()
 
     def setup(self, instance_args, init_model_stats=None) -> None:
         """Setup the agent for a new instance."""
         self.model.reset_stats(init_model_stats)
         self.instance_args = instance_args
+        self.observation_cache = ObservationCache()
+        self.loop_detector = LoopDetector(self.config.loop_max_repeats, self.config.loop_max_cycle_length)
+
+        self.prompt_prefix = self.get_prompt_prefix()
+        logger.info(f"SYSTEM ({self.name})\n{self.prompt_prefix.entries[0]['content']}")
+        # The entries of the prefix are shared between instances and agents
+        self.history = list(self.prompt_prefix.entries)
 
-        system_msg = self.config.system_template.format(**self.system_args)
-        logger.info(f"SYSTEM ({self.name})\n{system_msg}")
+    def get_prompt_prefix(self) -> "PromptPrefix":
+        """Return the system message and demonstrations that start the history, built once per configuration and model."""
+        key = (
+            self.name,
+            type(self.model).__name__,
+            getattr(self.model, "api_model", None),
+            self.config.system_template.format(**self.system_args),
+            tuple(self.config.demonstrations),
+            self.config.demonstration_template,
+            self.config.put_demos_in_history,
+        )
+        with _prompt_prefixes_lock:
+            if key not in _prompt_prefixes:
+                _prompt_prefixes[key] = self._build_prompt_prefix(key[3])
+            return _prompt_prefixes[key]
 
-        self.history = [
+    def _build_prompt_prefix(self, system_msg: str) -> "PromptPrefix":
+        history = [
             {"role": "system", "content": system_msg, "agent": self.name},
         ]
 
@@ -215,7 +340,7 @@ class Agent:
 
                 # Load history
                 logger.info(f"DEMONSTRATION: {demonstration_path}")
-                demo_history = json.load(open(demonstration_path, "r"))["history"]
+                demo_history = load_demonstration_history(demonstration_path)
                 demo_history = [
                     entry for entry in demo_history
                     if ("agent" not in entry) or
@@ -228,8 +353,7 @@ class Agent:
                     # Add demonstration to history directly as separate messages
                     for entry in demo_history:
                         if entry["role"] != "system":
-                            entry["is_demo"] = True
-                            self.history.append(entry)
+                            history.append({**entry, "is_demo": True})
                 else:
                     # Add demonstration as single message to history
                     demo_message = self.model.history_to_messages(
@@ -239,22 +363,90 @@ class Agent:
                     demonstration = self.config.demonstration_template.format(
                         **{"demonstration": demo_message}
                     )
-                    self.history.append({
+                    history.append({
                         "agent": self.name,
                         "content": demonstration,
                         "is_demo": True,
                         "role": "user",
                     })
+        return PromptPrefix(
+            entries=tuple(history),
+            hash=hashlib.sha256(json.dumps(history, sort_keys=True).encode()).hexdigest(),
+        )
+
+    def fork(self) -> "Agent":
+        """Return a copy of the agent that can continue the current episode independently of this one.
+
+        History, trajectory and model stats are copied, while configuration, parsed command patterns and
+        the model client are shared. Use together with `SWEEnv.fork` and `run(..., resume=True)`.
+        """
+        agent = copy.copy(self)
+        agent.history = copy.deepcopy(self.history)
+        agent.trajectory = copy.deepcopy(self.trajectory)
+        agent.model = copy.copy(self.model)
+        agent.model.stats = copy.deepcopy(self.model.stats)
+        agent.model.reset_message_cache()
+        if self.repair_model is not None:
+            agent.repair_model = copy.copy(self.repair_model)
+            agent.repair_model.reset_message_cache()
+        agent.sub_agents = dict()
+        agent.observation_cache = ObservationCache()
+        agent.loop_detector = copy.deepcopy(self.loop_detector)
+        return agent
+
+    def _get_observation_cache_key(self, action: str, state: Optional[str]) -> Optional[tuple]:
+        """Return the key of `action` in the observation cache (None if its observation cannot be cached).
+
+        Only a single call of a read-only command without shell operators or expansions is cached.
+        Its observation depends on the files (covered by the generation of the cache) and the state
+        (e.g. the working directory and the open file).
+        """
+        if state is None or re.search(r"[;&|<>$`(){}\n]", action.strip()):
+            return None
+        try:
+            words = tuple(shlex.split(action))
+        except ValueError:
+            return None
+        if len(words) == 0 or words[0] not in self.read_only_commands:
+            return None
+        return (self.observation_cache.generation, state, words)
 
     @property
     def state_command(self) -> str:
         """Return the bash command that will be used to extract the environment state."""
         return self.config.state_command.name
     
+    def _reset_local_history(self) -> None:
+        """Reset the cached view of the history that backs `local_history`."""
+        self._local_history_source = self.history  # history (list object) the view was built from
+        self._local_history_seen = 0  # number of entries of `self.history` that were filtered
+        self._local_history_entries = []  # entries of this agent among them
+        self._local_history_last = None  # last filtered entry, to detect changes of the history
+        self._processed_history = ProcessedHistory(model=self.model)
+
     @property
     def local_history(self) -> list[dict[str, str]]:
-        """Return the history of the agent since the last reset."""
-        return self.config.history_processor([entry for entry in self.history if entry["agent"] == self.name])
+        """Return the history of the agent since the last reset.
+
+        The history is filtered and processed incrementally: only entries appended since the last call are
+        processed. The view is rebuilt if the history was replaced (e.g. by `setup`) or truncated.
+        The returned list must not be modified.
+        """
+        seen = self._local_history_seen
+        if (
+            self._local_history_source is not self.history
+            or seen > len(self.history)
+            or (seen > 0 and self.history[seen - 1] is not self._local_history_last)
+        ):
+            self._reset_local_history()
+            seen = 0
+        self._local_history_entries.extend(
+            entry for entry in self.history[seen:] if entry["agent"] == self.name
+        )
+        self._local_history_seen = len(self.history)
+        if self.history:
+            self._local_history_last = self.history[-1]
+        return self.config.history_processor.update(self._local_history_entries, self._processed_history)
 
     def save_trajectory(self, trajectory, traj_dir, env, info):
         log_path = traj_dir / (env.record['instance_id'] + ".traj")
@@ -268,26 +460,15 @@ class Agent:
             json.dump(log_dict, f, indent=2)
         logger.info(f"Saved trajectory to {log_path}")
 
-    def _get_first_match(self, action: str, pattern_type: str) -> Optional[re.Match]:
+    def _get_first_match(self, action: str, pattern_type: str) -> Optional[CommandMatch]:
         """Return the first match of a command pattern in the action string."""
-        if pattern_type == "subroutine":
-            patterns = {k: v for k, v in self.subroutine_patterns.items()}
-        elif pattern_type == "multi_line":
-            patterns = {k: v for k, v in self.command_patterns.items() if k in self.config.multi_line_command_endings or k == self.config.submit_command}
-            patterns += {k: v for k, v in self.subroutine_patterns.items() if k in self.config.multi_line_command_endings}
-        elif pattern_type == "multi_line_no_subroutines":
-            patterns = {k: v for k, v in self.command_patterns.items() if k in self.config.multi_line_command_endings}
-        else:
+        return next(self._get_lexer(pattern_type).finditer(action), None)
+
+    def _get_lexer(self, pattern_type: str) -> CommandLexer:
+        try:
+            return self.command_lexers[pattern_type]
+        except KeyError:
             raise ValueError(f"Unknown pattern type: {pattern_type}")
-        matches = list()
-        for name, pat in patterns.items():
-            match = pat.search(action)
-            if match:
-                matches.append(match)
-        if len(matches) == 0:
-            return None
-        matches = sorted(matches, key=lambda x: x.start())
-        return matches[0]
 
     def _guard_multiline_input(self, action: str) -> str:
         """Split action by multiline commands, then append the first line in each multiline command with "<< '{end_name}'".
@@ -296,53 +477,44 @@ class Agent:
         Their multi-line argument is sent using a heredoc, which is a way to send a multi-line string to a command in bash.
         """
         parsed_action = list()
-        rem_action = action
-        while rem_action.strip():
-            first_match = self._get_first_match(rem_action, "multi_line_no_subroutines")
-            if first_match:
-                pre_action = rem_action[:first_match.start()]
-                match_action = rem_action[first_match.start():first_match.end()]
-                rem_action = rem_action[first_match.end():]
-                if pre_action.strip():
-                    parsed_action.append(pre_action)
-                if match_action.strip():
-                    eof = first_match.group(3).strip()
-                    if not match_action.split('\n')[0].strip().endswith(f"<< '{eof}'"):
-                        guarded_command = match_action[first_match.start():]
-                        first_line = guarded_command.split('\n')[0]
-                        guarded_command = guarded_command.replace(
-                            first_line,
-                            first_line + f" << '{eof}'",
-                            1
-                        )
-                        parsed_action.append(guarded_command)
-                    else:
-                        parsed_action.append(match_action)
-            else:
-                parsed_action.append(rem_action)
-                rem_action = ""
+        pos = 0
+        for match in self._get_lexer("multi_line_no_subroutines").finditer(action):
+            pre_action = action[pos:match.start()]
+            match_action = action[match.start():match.end()]
+            pos = match.end()
+            if pre_action.strip():
+                parsed_action.append(pre_action)
+            if match_action.strip():
+                eof = match.group(3).strip()
+                # The first line is the one with the command name (the match can start with empty lines)
+                first_line_end = match_action.find('\n', match.end(1) - match.start())
+                if first_line_end == -1:
+                    first_line_end = len(match_action)
+                first_line = match_action[:first_line_end]
+                if not first_line.strip().endswith(f"<< '{eof}'"):
+                    match_action = first_line + f" << '{eof}'" + match_action[first_line_end:]
+                parsed_action.append(match_action)
+        if action[pos:].strip():
+            parsed_action.append(action[pos:])
         return '\n'.join(parsed_action)
 
     def split_actions(self, action: str, pattern_type="subroutine") -> list[str]:
         """Split an action into a list of actions in a greedy manner, each of which is a subroutine call or a single command."""
         parsed_action = list()
-        rem_action = action
-        while rem_action.strip():
-            first_match = self._get_first_match(rem_action, pattern_type)
-            if first_match:
-                pre_action = rem_action[:first_match.start()]
-                match_action = rem_action[first_match.start():first_match.end()]
-                rem_action = rem_action[first_match.end():]
-                if pre_action.strip():
-                    parsed_action.append({'agent': self.name, 'action': pre_action, 'cmd_name': None})
-                if match_action.strip():
-                    if match_action.split()[0] == self.config.submit_command:
-                        parsed_action.append({'agent': self.name, 'action': match_action, 'cmd_name': first_match.group(1)})  # submit command is not a subroutine
-                    else:
-                        parsed_action.append({'agent': first_match.group(1), 'args': first_match.group(2), 'action': match_action, 'cmd_name': first_match.group(1)})
-            else:
-                parsed_action.append({'agent': self.name, 'action': rem_action, 'cmd_name': None})
-                rem_action = ""
+        pos = 0
+        for match in self._get_lexer(pattern_type).finditer(action):
+            pre_action = action[pos:match.start()]
+            match_action = action[match.start():match.end()]
+            pos = match.end()
+            if pre_action.strip():
+                parsed_action.append({'agent': self.name, 'action': pre_action, 'cmd_name': None})
+            if match_action.strip():
+                if match_action.split()[0] == self.config.submit_command:
+                    parsed_action.append({'agent': self.name, 'action': match_action, 'cmd_name': match.group(1)})  # submit command is not a subroutine
+                else:
+                    parsed_action.append({'agent': match.group(1), 'args': match.group(2), 'action': match_action, 'cmd_name': match.group(1)})
+        if action[pos:].strip():
+            parsed_action.append({'agent': self.name, 'action': action[pos:], 'cmd_name': None})
         return parsed_action
     
     def _parse_command_patterns(self):
@@ -358,7 +530,7 @@ class Agent:
         for _, subroutine in self.config._subroutines.items():
             if subroutine.end_name is None:
                 pat = re.compile(fr'^\s*({subroutine.name})\s*(.*?)$', re.MULTILINE)
-                self.subroutine_patterns[subroutine.name,] = pat
+                self.subroutine_patterns[subroutine.name] = pat
             else:
                 pat = re.compile(fr'^\s*({subroutine.name})\s*(.*?)^({subroutine.end_name})\s*$', re.DOTALL | re.MULTILINE)
                 self.subroutine_patterns[subroutine.name] = pat
@@ -368,9 +540,33 @@ class Agent:
             submit_pat = re.compile(rf'^\s*({self.config.submit_command})(\s*)$', re.MULTILINE)  # group 2 is nothing
         self.subroutine_patterns[self.config.submit_command] = submit_pat
         self.command_patterns[self.config.submit_command] = submit_pat
+        # One lexer per pattern type, each finds all commands of that type in a single pass
+        multi_line_endings = self.config.multi_line_command_endings
+        self.command_lexers = {
+            "subroutine": CommandLexer(list(self.subroutine_patterns.values())),
+            "multi_line": CommandLexer(
+                [v for k, v in self.command_patterns.items() if k in multi_line_endings or k == self.config.submit_command]
+                + [v for k, v in self.subroutine_patterns.items() if k in multi_line_endings]
+            ),
+            "multi_line_no_subroutines": CommandLexer(
+                [v for k, v in self.command_patterns.items() if k in multi_line_endings]
+            ),
+        }
+
+    def _dispatch(self, name: str, *args) -> Steps:
+        """
+        Steps of the public method `name` (e.g. `forward`): the steps of `_<name>`, or a blocking call of `name`
+        if a subclass overrides it, so that overrides of the public methods are used by `run` and `arun` as well.
+        """
+        if getattr(type(self), name) is getattr(Agent, name):
+            return (yield from getattr(self, f"_{name}")(*args))
+        return (yield BlockingCall(getattr(self, name), *args))
 
     def forward(self, observation: str, available_actions: list[str], state: str) -> Tuple[str, str, str]:
-        thought, action, output = self.forward_with_error_check(observation, state)
+        return run_steps(self._forward(observation, available_actions, state))
+
+    def _forward(self, observation: str, available_actions: list[str], state: str) -> Steps:
+        thought, action, output = yield from self._dispatch("forward_with_error_check", observation, state)
 
         self.history.append(
             {"role": "assistant",
@@ -390,7 +586,9 @@ class Agent:
         """Query the model with the current state and observation with the appropriate template.
 
         Returns the model output."""
+        return run_steps(self._forward_model(observation, state))
 
+    def _forward_model(self, observation: str, state: str) -> Steps:
         state_vars = json.loads(state)
 
         templates = []
@@ -424,34 +622,55 @@ class Agent:
         logger.info(f"🤖 MODEL INPUT\n{message}")
         self.history.append({"role": "user", "content": message, "agent": self.name})
 
-        return self.model.query(self.local_history)
+        return (yield ModelQuery(self.model, self.local_history))
 
-    def retry_after_format_fail(self, output):
+    def retry_after_format_fail(self, output, use_repair_model: bool = False):
         """Ask the model to correct (without committing to persistent history) after a malformatted model output"""
+        return run_steps(self._retry_after_format_fail(output, use_repair_model))
+
+    def _retry_after_format_fail(self, output, use_repair_model: bool = False) -> Steps:
         format_error_template = self.config.format_error_template
 
         logger.warning(f"MALFORMED OUTPUT\n{output}")
         logger.warning(f"FORMAT ERROR\n{format_error_template}")
 
-        temp_history = self.local_history + [
-            {"role": "assistant", "content": output, "agent": self.name},
-            {"role": "user", "content": format_error_template, "agent": self.name},
-        ]
-        return self.model.query(temp_history)
+        return (yield from self._query_repair(output, format_error_template, use_repair_model))
 
-    def retry_after_blocklist_fail(self, output, action):
+    def retry_after_blocklist_fail(self, output, action, use_repair_model: bool = False):
         """Ask the model to correct (without committing to persistent history) after a disallowed command"""
+        return run_steps(self._retry_after_blocklist_fail(output, action, use_repair_model))
+
+    def _retry_after_blocklist_fail(self, output, action, use_repair_model: bool = False) -> Steps:
         name = action.strip().split()[0]
         blocklist_error_message = self.config.blocklist_error_template.format(name=name)
 
         logger.warning(f"BLOCKLISTED OUTPUT\n{output}")
         logger.warning(f"BLOCKLIST ERROR\n{blocklist_error_message}")
 
-        temp_history = self.local_history + [
+        return (yield from self._query_repair(output, blocklist_error_message, use_repair_model))
+
+    def _query_repair(self, output: str, error_message: str, use_repair_model: bool) -> Steps:
+        """
+        Ask for a corrected `output` after `error_message`. The repair model only gets a compact context (the
+        system message and the last message to the model), the primary model gets the full history.
+        """
+        repair = [
             {"role": "assistant", "content": output, "agent": self.name},
-            {"role": "user", "content": blocklist_error_message, "agent": self.name},
+            {"role": "user", "content": error_message, "agent": self.name},
         ]
-        return self.model.query(temp_history)
+        local_history = self.local_history
+        if use_repair_model and self.repair_model is not None:
+            context = [entry for entry in local_history if entry["role"] == "system"]
+            context += [entry for entry in local_history if entry["role"] == "user"][-1:]
+            # Repair queries count towards the stats (and cost limits) of the agent
+            self.repair_model.stats = self.model.stats
+            try:
+                return (yield ModelQuery(self.repair_model, context + repair))
+            except (KeyboardInterrupt, CostLimitExceededError):
+                raise
+            except Exception as e:
+                logger.warning(f"Repair model failed, falling back to the primary model: {e}")
+        return (yield ModelQuery(self.model, local_history + repair))
 
     def should_block_action(self, action):
         """Check if the command should be blocked."""
@@ -474,6 +693,9 @@ class Agent:
 
         Returns the thought, action, and raw model output.
         """
+        return run_steps(self._check_format_and_requery(output))
+
+    def _check_format_and_requery(self, output: str) -> Steps:
         # Condition for handling outputs with no thought (just action)
         if self.model.args.model_name == "human":
             return "", output, output
@@ -486,6 +708,8 @@ class Agent:
             return thought, action, output
 
         format_fails = blocklist_fails = 0
+        # The first repair is asked of the repair model, if its output fails as well, the primary model repairs it
+        use_repair_model = self.repair_model is not None
 
         while format_fails + blocklist_fails <= 2:
             try:
@@ -498,19 +722,24 @@ class Agent:
                 raise
             except FormatError as e:
                 format_fails += 1
-                output = self.retry_after_format_fail(output)
+                output = yield from self._dispatch("retry_after_format_fail", output, use_repair_model)
+                use_repair_model = False
                 continue
             if self.should_block_action(action):
                 blocklist_fails += 1
-                output = self.retry_after_blocklist_fail(output, action)
+                output = yield from self._dispatch("retry_after_blocklist_fail", output, action, use_repair_model)
+                use_repair_model = False
             else:
                 return thought, action, output
         logger.warning(f"Malformat limit reached: \n{output}")
         return "Exit due to format error", "exit_format", output
 
     def forward_with_error_check(self, observation: str, state: str) -> Tuple[str, str, str]:
+        return run_steps(self._forward_with_error_check(observation, state))
+
+    def _forward_with_error_check(self, observation: str, state: str) -> Steps:
         try:
-            output = self.forward_model(observation, state)
+            output = yield from self._dispatch("forward_model", observation, state)
         except KeyboardInterrupt:
             raise
         except RuntimeError as e:
@@ -533,7 +762,7 @@ class Agent:
                 "exit_api",
                 f"exit due to retry error: {e}",
             )
-        return self.check_format_and_requery(output)
+        return (yield from self._dispatch("check_format_and_requery", output))
     
     def init_environment_vars(self, env):
         self.set_environment_vars(env, self.config.env_variables)
@@ -555,6 +784,10 @@ class Agent:
         except Exception as e:
                 logger.warning("Failed to set environment variables")
                 raise e
+        self.install_commands(env)
+
+    def install_commands(self, env):
+        """Install the command files of the agent (skipped by the environment if they are already installed)"""
         command_files = list()
         for file in self.config.command_files:
             datum = dict()
@@ -583,35 +816,88 @@ class Agent:
             command_files.append(datum)
         env.add_commands(command_files)
     
-    def get_environment_vars(self, env):
-        env_vars = dict()
-        for var in self.config.env_variables:
-            env_vars[var] = env.communicate(f"echo ${var}").strip()
-        return env_vars
-    
+    def get_environment_vars(self, env) -> dict:
+        """Capture the environment variables of the agent and the working directory (see `SWEEnv.snapshot_environment_vars`)"""
+        return env.snapshot_environment_vars(list(self.config.env_variables))
+
+    def restore_environment_vars(self, env, snapshot: dict) -> None:
+        """Restore the state command, environment variables, working directory and commands of the agent"""
+        env.restore_environment_vars(snapshot, init_code=self.config.state_command.code)
+        self.install_commands(env)
+
+    def get_checkpoint(self, env, observation: Optional[str]) -> dict:
+        """
+        Capture the state of the episode that is not part of the history: the changes to the repository,
+        the environment variables and working directory, and the observation for the next step.
+        The patch is only included if it changed since the last checkpoint of the journal (see `load_checkpoint`),
+        so that the journal does not grow with a copy of the patch per step.
+        """
+        patch, self.checkpoint_patch_hash = env.get_changed_workspace_patch(self.checkpoint_patch_hash)
+        checkpoint = {
+            "patch_hash": self.checkpoint_patch_hash,
+            "environment": self.get_environment_vars(env),
+            "observation": observation,
+        }
+        if patch is not None:
+            checkpoint["patch"] = patch
+        return checkpoint
+
+    def restore_checkpoint(self, setup_args, env, content: dict) -> Optional[str]:
+        """
+        Restore an episode from a journal loaded with `load_checkpoint` in an environment that has been
+        reset to the same task instance. Continue the episode with `run(..., resume=True)` and the returned observation.
+        """
+        self.setup(setup_args)
+        self.init_environment_vars(env)
+        self.last_container_id = env.container_obj.id
+        checkpoint = content["checkpoint"]
+        env.apply_workspace_patch(checkpoint["patch"])
+        self.restore_environment_vars(env, checkpoint["environment"])
+        self.history = content["history"]
+        self.trajectory = content["trajectory"]
+        # The cost of the steps before the checkpoint counts towards the instance, but was spent in an earlier run
+        stats = APIStats(**content["info"]["model_stats"])
+        stats.total_cost = self.model.stats.total_cost + stats.instance_cost
+        self.model.stats = stats
+        return checkpoint["observation"]
+
+    def get_sub_agent(self, agent_name: str) -> "Agent":
+        """Return the agent for a subroutine, which is constructed on its first call and reused afterwards.
+
+        Its model client and command patterns are kept, while `run` resets history and stats for every call.
+        """
+        if agent_name not in self.sub_agents:
+            self.sub_agents[agent_name] = Agent(agent_name, self.config._subroutines[agent_name].agent_args)
+        sub_agent = self.sub_agents[agent_name]
+        # The environment variables and commands of the calling agent are restored after each call
+        sub_agent.last_container_id = None
+        return sub_agent
+
     def call_subroutine(self, agent_name, sub_action, env):
-        env_vars = self.get_environment_vars(env)
-        cwd = env.communicate("pwd -P").strip()
+        return run_steps(self._call_subroutine(agent_name, sub_action, env))
+
+    def _call_subroutine(self, agent_name, sub_action, env) -> Steps:
+        env_snapshot = yield BlockingCall(self.get_environment_vars, env)
         init_observation = self.config._subroutines[agent_name].init_observation
         if init_observation is not None:
-            obs, _, _, _ = env.step(init_observation.format(args=sub_action['args']))
+            obs, _, _, _ = yield BlockingCall(env.step, init_observation.format(args=sub_action['args']))
         else:
             obs = None
         if env.returncode != 0:
             self.history.append({"role": "user", "content": obs, "agent": agent_name})
             raise RuntimeError(f"Nonzero return code: {env.returncode} for init_observation in {agent_name}.\n{obs}")
         return_type = self.config._subroutines[agent_name].return_type
-        sub_agent = Agent(agent_name, self.config._subroutines[agent_name].agent_args)
-        sub_agent_output = sub_agent.run(
-            {"issue": sub_action['args']},
-            env,
+        sub_agent = self.get_sub_agent(agent_name)
+        sub_agent_output = yield AgentRun(
+            sub_agent,
+            setup_args={"issue": sub_action['args']},
+            env=env,
             observation=obs,
             return_type=return_type,
             init_model_stats=self.model.stats,
-            )
+        )
         self.history += sub_agent.history
-        self.set_environment_vars(env, env_vars)
-        env.communicate(f"cd {cwd}")
+        yield BlockingCall(self.restore_environment_vars, env, env_snapshot)
         self.model.stats.replace(sub_agent.model.stats)
         return sub_agent_output
 
@@ -623,34 +909,129 @@ class Agent:
             traj_dir: Optional[Path] = None,
             return_type: Optional[str] = "info",
             init_model_stats: Optional[APIStats] = None,
+            resume: bool = False,
+            traj_fsync_every: int = 0,
+            save_checkpoints: bool = False,
         ):
         """
         Run the agent on an environment.
+        If `resume` is True, continue the episode from the current history and trajectory instead of
+        starting a new one (e.g. for an agent and environment obtained with `fork`).
+        If `traj_dir` is given, every step is appended to a journal (fsynced every `traj_fsync_every` steps)
+        that is replaced by the `.traj` file at the end of the episode. With `save_checkpoints`, every record
+        of the journal also holds a checkpoint of the environment (see `get_checkpoint`), so that an episode
+        interrupted by an infrastructure failure can be continued with `restore_checkpoint`.
         Return the final value of the specified return type.
         """
+        return run_steps(self._run(
+            setup_args, env, observation, traj_dir, return_type, init_model_stats, resume, traj_fsync_every, save_checkpoints,
+        ))
+
+    async def arun(
+            self,
+            setup_args,
+            env: SWEEnv,
+            observation: str = None,
+            traj_dir: Optional[Path] = None,
+            return_type: Optional[str] = "info",
+            init_model_stats: Optional[APIStats] = None,
+            resume: bool = False,
+            traj_fsync_every: int = 0,
+            save_checkpoints: bool = False,
+        ):
+        """
+        Async version of `run`: the model is queried with its async client and commands in the environment run
+        in worker threads, so that many episodes (each with its own agent, e.g. from `fork`, and environment)
+        can run concurrently in one event loop.
+        """
+        return await arun_steps(self._run(
+            setup_args, env, observation, traj_dir, return_type, init_model_stats, resume, traj_fsync_every, save_checkpoints,
+        ))
+
+    def _run(
+            self,
+            setup_args,
+            env: SWEEnv,
+            observation: str,
+            traj_dir: Optional[Path],
+            return_type: Optional[str],
+            init_model_stats: Optional[APIStats],
+            resume: bool,
+            traj_fsync_every: int,
+            save_checkpoints: bool,
+        ) -> Steps:
         done = False
 
-        if env.container_obj.id != self.last_container_id:
+        if resume:
+            # Shell state of the environment already belongs to this episode
+            self.last_container_id = env.container_obj.id
+        elif env.container_obj.id != self.last_container_id:
             logger.info(f"Initializing agent settings for container {env.container_obj.id}")
-            self.init_environment_vars(env)
+            yield BlockingCall(self.init_environment_vars, env)
             self.last_container_id = env.container_obj.id
-        # Re-initialize primary
-        self.setup(setup_args, init_model_stats)
+        if not resume:
+            # Re-initialize primary
+            self.setup(setup_args, init_model_stats)
+            self.trajectory = []
 
         # Run action/observation loop
-        trajectory = []
+        trajectory = self.trajectory
         info = {}
+        journal = None
+        if traj_dir:
+            journal = yield BlockingCall(
+                TrajectoryJournal,
+                traj_dir / (env.record['instance_id'] + ".traj"),
+                env.name,
+                fsync_every=traj_fsync_every,
+            )
+            # The first checkpoint of a journal always includes the patch
+            self.checkpoint_patch_hash = None
+            if resume and save_checkpoints:
+                # A new journal replaces the one of the interrupted run
+                checkpoint = yield BlockingCall(self.get_checkpoint, env, observation)
+                yield BlockingCall(journal.append, self.history, trajectory, info, checkpoint=checkpoint)
+        # State after the last action, returned by `env.step` with the output of the action
+        state = None
+        exit_loop = False
         while not done:
-            state = env.communicate(self.state_command) if self.state_command else None
-            thought, action, output = self.forward(
-                observation,
-                env.get_available_actions(),
-                state)
+            if state is None and self.state_command:
+                # Stripped like the state of the trailer (see `SWEEnv._split_state_trailer`), so that both compare
+                state = (yield BlockingCall(env.communicate, self.state_command)).strip()
+            if exit_loop:
+                thought, action, output = "Exit due to repeated actions", "exit_loop", "Exit due to repeated actions"
+                self.history.append(
+                    {"role": "assistant", "content": output, "thought": thought, "action": action, "agent": self.name}
+                )
+            else:
+                thought, action, output = yield from self._dispatch(
+                    "forward",
+                    observation,
+                    env.get_available_actions(),
+                    state)
+            trajectory_state = state
             observations = list()
             run_action = self._guard_multiline_input(action)
             for sub_action in self.split_actions(run_action):
                 if sub_action['agent'] == self.name or sub_action['cmd_name'] == self.config.submit_command:
-                    obs, _, done, info = env.step(sub_action['action'])
+                    cache_key = self._get_observation_cache_key(sub_action['action'], state)
+                    if cache_key is not None and cache_key in self.observation_cache:
+                        logger.info("Using cached observation of read-only command")
+                        obs, done = self.observation_cache[cache_key], False
+                    else:
+                        obs, _, done, info = yield BlockingCall(
+                            env.step,
+                            sub_action['action'],
+                            state_command=(self.state_command or None) if self.config.state_trailer else None,
+                        )
+                        previous_state, state = state, info.pop("state", None)
+                        if state is None and cache_key is not None and not done and self.state_command:
+                            # Without state trailer, the state is needed to check that the command did not change it
+                            state = (yield BlockingCall(env.communicate, self.state_command)).strip()
+                        if cache_key is not None and state == previous_state and "exit_status" not in info:
+                            self.observation_cache[cache_key] = obs
+                        else:
+                            self.observation_cache.invalidate()
                     observations.append(obs)
                     if sub_action['cmd_name'] == self.config.submit_command:
                         done = True
@@ -658,8 +1039,10 @@ class Agent:
                         break
                 else:
                     agent_name = sub_action['agent']
-                    sub_agent_output = self.call_subroutine(agent_name, sub_action, env)
+                    sub_agent_output = yield from self._dispatch("call_subroutine", agent_name, sub_action, env)
                     observations.append(sub_agent_output)
+                    self.observation_cache.invalidate()
+                    state = None
 
             observation = '\n'.join([obs for obs in observations if obs is not None])
 
@@ -668,13 +1051,37 @@ class Agent:
                     "action": action,
                     "observation": observation,
                     "response": output,
-                    "state": state,
+                    "state": trajectory_state,
                     "thought": thought,
                 }
             )
+            cycle_length = None if done else self.loop_detector.add(action, observation)
+            if cycle_length is not None:
+                n_steps = cycle_length * self.loop_detector.max_repeats
+                exit_loop = len(self.loop_detector.triggers) >= self.config.loop_max_corrections
+                logger.warning(f"Loop detected: {n_steps} steps repeated a cycle of {cycle_length} step(s)")
+                self.loop_detector.triggers.append({
+                    "step": len(trajectory),
+                    "cycle_length": cycle_length,
+                    "response": "exit" if exit_loop else "correction",
+                })
+                if not exit_loop:
+                    observation += "\n" + self.config.loop_error_template.format(
+                        n_steps=n_steps, cycle_length=cycle_length,
+                    )
             info['model_stats'] = self.model.stats.to_dict()
-            if traj_dir:
-                self.save_trajectory(trajectory, traj_dir, env, info)
+            if self.loop_detector.triggers:
+                info['loop_detections'] = self.loop_detector.triggers
+            if journal is not None:
+                checkpoint = None
+                if save_checkpoints and not done and not exit_loop:
+                    checkpoint = yield BlockingCall(self.get_checkpoint, env, observation)
+                yield BlockingCall(journal.append, self.history, trajectory, info, checkpoint=checkpoint)
+        if journal is not None:
+            yield BlockingCall(self.save_trajectory, trajectory, traj_dir, env, info)
+            if not (save_checkpoints and info.get("exit_status") == "early_exit"):
+                # The checkpoints of an episode that was cut short by the environment are kept for resuming
+                yield BlockingCall(journal.remove)
         if return_type == "info":
             return info
         if return_type == "info_trajectory":
@@ -4,7 +4,7 @@ import yaml
 from abc import abstractmethod
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 from simple_parsing.helpers import FrozenSerializable
 
 
@@ -32,6 +32,43 @@ class Command(FrozenSerializable):
     end_name: Optional[str] = None  # if there is an end_name, then it is a multi-line command
     arguments: Optional[Dict] = None
     signature: Optional[str] = None
+    read_only: bool = False  # if true, the command changes neither files nor the shell state (its output can be cached)
+
+
+class CommandMatch:
+    """Match of a single command pattern within a match of a `CommandLexer` (groups are numbered as in the command pattern)"""
+    def __init__(self, match: re.Match, offset: int):
+        self._match = match
+        self._offset = offset  # index of the group around the command pattern
+
+    def start(self, group: int = 0) -> int:
+        return self._match.start(self._offset + group)
+
+    def end(self, group: int = 0) -> int:
+        return self._match.end(self._offset + group)
+
+    def group(self, group: int = 0) -> str:
+        return self._match.group(self._offset + group)
+
+
+class CommandLexer:
+    """
+    Finds the commands in an action in a single pass, using one regular expression that combines the patterns
+    of all commands. The patterns are tried in order at each position, so the earliest match wins and ties
+    go to the first pattern (as when searching with each pattern separately).
+    """
+    def __init__(self, patterns: List[re.Pattern]):
+        alternatives = list()
+        for pat in patterns:
+            flags = "s" if pat.flags & re.DOTALL else ""
+            alternatives.append(f"(?{flags}:({pat.pattern}))")
+        self.pattern = re.compile("|".join(alternatives) or "(?!)", re.MULTILINE)
+
+    def finditer(self, action: str) -> Iterator[CommandMatch]:
+        """Iterate over the (non-overlapping) command matches in `action`"""
+        for match in self.pattern.finditer(action):
+            # The group around the matching pattern closes last
+            yield CommandMatch(match, match.lastindex)
 
 
 class ParseCommandMeta(type):
@@ -119,12 +156,13 @@ class ParseCommandBash(ParseCommand):
                     code += lines[idx]
                     idx += 1
                 code += lines[idx]
-                docstring, end_name, arguments, signature = None, None, None, name
+                docstring, end_name, arguments, signature, read_only = None, None, None, name, False
                 docs_dict = yaml.safe_load("\n".join(docs).replace('@yaml', ''))
                 if docs_dict is not None:
                     docstring = docs_dict["docstring"]
                     end_name = docs_dict.get("end_name", None)
                     arguments = docs_dict.get("arguments", None)
+                    read_only = docs_dict.get("read_only", False)
                     if "signature" in docs_dict:
                         signature = docs_dict["signature"]
                     else:
@@ -140,7 +178,8 @@ class ParseCommandBash(ParseCommand):
                     "end_name": end_name,
                     "name": name,
                     "arguments": arguments,
-                    "signature": signature
+                    "signature": signature,
+                    "read_only": read_only,
                 })
                 commands.append(command)
                 docs = []
@@ -165,6 +204,7 @@ class ParseCommandBash(ParseCommand):
             end_name = docs_dict.get("end_name", None)
             arguments = docs_dict.get("arguments", None)
             signature = docs_dict.get("signature", None)
+            read_only = docs_dict.get("read_only", False)
             name = Path(path).name.rsplit(".", 1)[0]
             if signature is None and arguments is not None:
                 signature = name
@@ -180,7 +220,8 @@ class ParseCommandBash(ParseCommand):
                 "end_name": end_name,
                 "name": name,
                 "arguments": arguments,
-                "signature": signature
+                "signature": signature,
+                "read_only": read_only,
             })]
 
 
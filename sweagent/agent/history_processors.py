@@ -1,12 +1,23 @@
 import re
 
 from abc import abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from sweagent.agent.tokens import TiktokenCounter
+from typing import Any
 
 
 class FormatError(Exception):
     pass
 
+
+@dataclass
+class ProcessedHistory:
+    """Output of a `HistoryProcessor` that can be updated incrementally as entries are appended to the history."""
+    entries: list = field(default_factory=list)  # processed history
+    n_processed: int = 0  # number of (raw) history entries that `entries` accounts for
+    state: dict = field(default_factory=dict)  # processor specific bookkeeping
+    model: Any = None  # model of the agent whose history is processed (e.g. for its context window and tokenizer)
+
 # ABSTRACT BASE CLASSES
 
 class HistoryProcessorMeta(type):
@@ -27,7 +38,18 @@ class HistoryProcessor(metaclass=HistoryProcessorMeta):
     @abstractmethod
     def __call__(self, history: list[str]) -> list[str]:
         raise NotImplementedError
-    
+
+    def update(self, history: list[str], processed: ProcessedHistory) -> list[str]:
+        """
+        Update `processed` for `history`, of which only the first `processed.n_processed` entries
+        have been processed before (and have not changed since). Returns the processed history.
+        Processors that can reuse earlier results override this to only process the new entries,
+        the default processes the full history again.
+        """
+        processed.entries = self(history)
+        processed.n_processed = len(history)
+        return processed.entries
+
     @classmethod
     def get(cls, name, *args, **kwargs):
         try:
@@ -41,6 +63,11 @@ class DefaultHistoryProcessor(HistoryProcessor):
     def __call__(self, history):
         return history
 
+    def update(self, history, processed):
+        processed.entries.extend(history[processed.n_processed:])
+        processed.n_processed = len(history)
+        return processed.entries
+
 
 def last_n_history(history, n):
     if n <= 0:
@@ -66,6 +93,32 @@ def last_n_history(history, n):
     return new_history
 
 
+def _omit_output(entry):
+    data = entry.copy()
+    data['content'] = f'Old output omitted ({len(entry["content"].splitlines())} lines)'
+    return data
+
+
+def last_n_history_update(history, processed, n):
+    """Incremental version of `last_n_history`: only entries that are new or that drop out of the last n are processed."""
+    if n <= 0:
+        raise ValueError('n must be a positive integer')
+    # Positions of the (non-demo) user messages in the history
+    user_positions = processed.state.setdefault('user_positions', [])
+    n_user_messages = len(user_positions)
+    for idx in range(processed.n_processed, len(history)):
+        entry = history[idx]
+        if entry['role'] == 'user' and not entry.get('is_demo', False):
+            user_positions.append(idx)
+        processed.entries.append(entry)
+    # The first user message is always kept, messages before the last n are omitted
+    for user_msg_idx in range(max(2, n_user_messages - n + 1), len(user_positions) - n + 1):
+        idx = user_positions[user_msg_idx - 1]
+        processed.entries[idx] = _omit_output(history[idx])
+    processed.n_processed = len(history)
+    return processed.entries
+
+
 class LastNObservations(HistoryProcessor):
     def __init__(self, n):
         self.n = n
@@ -73,16 +126,25 @@ class LastNObservations(HistoryProcessor):
     def __call__(self, history):
         return last_n_history(history, self.n)
 
+    def update(self, history, processed):
+        return last_n_history_update(history, processed, self.n)
+
 
 class Last2Observations(HistoryProcessor):
     def __call__(self, history):
         return last_n_history(history, 2)
 
+    def update(self, history, processed):
+        return last_n_history_update(history, processed, 2)
+
 
 class Last5Observations(HistoryProcessor):
     def __call__(self, history):
         return last_n_history(history, 5)
 
+    def update(self, history, processed):
+        return last_n_history_update(history, processed, 5)
+
 
 class ClosedWindowHistoryProcessor(HistoryProcessor):
     pattern = re.compile(r'^(\d+)\:.*?(\n|$)', re.MULTILINE)
@@ -121,3 +183,114 @@ class ClosedWindowHistoryProcessor(HistoryProcessor):
             new_history.append(data)
         history = list(reversed(new_history))
         return history
+
+    def _close_window(self, entry, matches):
+        data = entry.copy()
+        start = matches[0].start()
+        end = matches[-1].end()
+        data['content'] = (
+            entry['content'][:start] +\
+            f'Outdated window with {len(matches)} lines omitted...\n' +\
+            entry['content'][end:]
+        )
+        return data
+
+    def update(self, history, processed):
+        """
+        Incremental version of `__call__`: a new window for a file closes the previous window for that file,
+        which is the only earlier entry that changes.
+        """
+        # Maps each file to the position (in the processed history) of its last open window
+        open_windows = processed.state.setdefault('open_windows', dict())
+        for entry in history[processed.n_processed:]:
+            if entry['role'] != 'user' or entry.get('is_demo', False):
+                processed.entries.append(entry)
+                continue
+            if self.pattern.search(entry['content']):
+                file_match = self.file_pattern.search(entry['content'])
+                if not file_match:
+                    # Consistent with `__call__`, which skips these entries
+                    continue
+                file = file_match.group(1)
+                if file in open_windows:
+                    idx = open_windows[file]
+                    previous = processed.entries[idx]
+                    processed.entries[idx] = self._close_window(
+                        previous, list(self.pattern.finditer(previous['content']))
+                    )
+                open_windows[file] = len(processed.entries)
+            processed.entries.append(entry)
+        processed.n_processed = len(history)
+        return processed.entries
+
+
+class TokenBudgetHistoryProcessor(HistoryProcessor):
+    """
+    Keeps the prompt within the context window of the model by omitting the oldest observations.
+
+    Tokens are counted locally with the `token_counter` of the agent's model and cached per entry. While the
+    history exceeds `max_context - reserved_output_tokens`, the oldest observations are replaced by a short
+    summary. The system message, demonstrations, the first instance message and the latest entry are never changed.
+    The processor is shared by all agents of a config, the budget of each agent is kept in its `ProcessedHistory`.
+    """
+
+    def __init__(self, max_context: int = None, reserved_output_tokens: int = 4096, encoding: str = "cl100k_base"):
+        """
+        Args:
+            max_context: context window in tokens (taken from the `model_metadata` of the agent's model if unset)
+            reserved_output_tokens: tokens kept free for the response of the model
+            encoding: `tiktoken` encoding used to count tokens if the history is processed without a model
+        """
+        self.max_context = max_context
+        self.reserved_output_tokens = reserved_output_tokens
+        self.encoding = encoding
+        self._counter = TiktokenCounter(encoding)
+
+    def _get_counter(self, processed):
+        return getattr(processed.model, "token_counter", None) or self._counter
+
+    def _get_max_context(self, processed):
+        if self.max_context is not None:
+            return self.max_context
+        return getattr(processed.model, "model_metadata", {}).get("max_context")
+
+    def __call__(self, history):
+        return self.update(history, ProcessedHistory())
+
+    def update(self, history, processed):
+        """
+        Omitting observations only ever becomes necessary for older entries as the history grows,
+        so the entries are processed oldest first and the position of the next candidate is kept.
+        """
+        state = processed.state
+        state.setdefault('total_tokens', 0)
+        state.setdefault('next_candidate', 0)
+        state.setdefault('seen_instance_message', False)
+        tokens = state.setdefault('tokens', [])  # token count of each processed entry
+        candidates = state.setdefault('candidates', [])  # positions of observations that may be omitted
+        counter = self._get_counter(processed)
+        for idx in range(processed.n_processed, len(history)):
+            entry = history[idx]
+            tokens.append(counter.count_entry(entry))
+            state['total_tokens'] += tokens[-1]
+            if entry['role'] == 'user' and not entry.get('is_demo', False):
+                if state['seen_instance_message']:
+                    candidates.append(idx)
+                state['seen_instance_message'] = True
+            processed.entries.append(entry)
+        processed.n_processed = len(history)
+        max_context = self._get_max_context(processed)
+        if max_context is None:
+            return processed.entries
+        budget = max_context - self.reserved_output_tokens
+        while state['total_tokens'] > budget and state['next_candidate'] < len(candidates):
+            idx = candidates[state['next_candidate']]
+            if idx == len(history) - 1:
+                # Latest entry
+                break
+            state['next_candidate'] += 1
+            processed.entries[idx] = _omit_output(history[idx])
+            n_tokens = counter.count_entry(processed.entries[idx])
+            state['total_tokens'] += n_tokens - tokens[idx]
+            tokens[idx] = n_tokens
+        return processed.entries
@@ -0,0 +1,123 @@
+import json
+import os
+
+from pathlib import Path
+from typing import Optional
+
+JOURNAL_SUFFIX = ".journal"
+
+
+class TrajectoryJournal:
+    """Append-only journal of an episode, written while the agent runs.
+
+    Every step appends a single JSON line with the new history entries, the new trajectory steps and the
+    current info, so saving a step costs O(step) instead of rewriting the whole trajectory.
+    At the end of the episode, the classic `.traj` file is written and the journal is removed.
+    """
+
+    def __init__(self, traj_path: Path, environment: str, fsync_every: int = 0):
+        """
+        Args:
+            traj_path: path of the `.traj` file of the episode
+            environment: name of the environment
+            fsync_every: fsync the journal every n records (0: leave flushing to the OS)
+        """
+        self.path = Path(traj_path).with_suffix(JOURNAL_SUFFIX)
+        self.fsync_every = fsync_every
+        self._n_history = 0
+        self._n_trajectory = 0
+        self._n_records = 0
+        with self.path.open("w") as f:
+            f.write(json.dumps({"environment": environment}) + "\n")
+
+    def append(self, history: list[dict], trajectory: list[dict], info: dict, checkpoint: Optional[dict] = None) -> None:
+        """
+        Append everything that was added to `history` and `trajectory` since the last call.
+        `checkpoint` is the state of the environment after the step that the episode can be resumed from.
+        """
+        record = {
+            "history": history[self._n_history:],
+            "trajectory": trajectory[self._n_trajectory:],
+            "info": info,
+        }
+        if checkpoint is not None:
+            record["checkpoint"] = checkpoint
+        with self.path.open("a") as f:
+            f.write(json.dumps(record) + "\n")
+            self._n_records += 1
+            if self.fsync_every > 0 and self._n_records % self.fsync_every == 0:
+                f.flush()
+                os.fsync(f.fileno())
+        self._n_history = len(history)
+        self._n_trajectory = len(trajectory)
+
+    def remove(self) -> None:
+        """Remove the journal (once the classic `.traj` file has been written)."""
+        if self.path.exists():
+            os.remove(self.path)
+
+
+def load_journal(path: Path) -> dict:
+    """Load a (possibly partial) journal into the classic trajectory format."""
+    content = {"environment": None, "trajectory": [], "history": [], "info": {}}
+    with Path(path).open("r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last record was not written completely
+                break
+            if "environment" in record:
+                content["environment"] = record["environment"]
+                continue
+            content["history"] += record["history"]
+            content["trajectory"] += record["trajectory"]
+            content["info"] = record["info"]
+    return content
+
+
+def load_checkpoint(path: Path) -> Optional[dict]:
+    """
+    Load a (possibly partial) journal up to its last checkpoint, i.e., the content of the journal as of the
+    last step that the episode can be resumed from, with the checkpoint under `"checkpoint"`.
+    Checkpoints only hold the workspace patch if it changed, the patch of the last one is filled in from
+    the latest checkpoint that has it. Returns None if the journal has no checkpoint.
+    """
+    content = {"environment": None, "trajectory": [], "history": [], "info": {}, "checkpoint": None}
+    n_history, n_trajectory = 0, 0
+    patch = None
+    with Path(path).open("r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last record was not written completely
+                break
+            if "environment" in record:
+                content["environment"] = record["environment"]
+                continue
+            content["history"] += record["history"]
+            content["trajectory"] += record["trajectory"]
+            if record.get("checkpoint") is not None:
+                patch = record["checkpoint"].get("patch", patch)
+                content["info"] = record["info"]
+                content["checkpoint"] = {**record["checkpoint"], "patch": patch}
+                n_history, n_trajectory = len(content["history"]), len(content["trajectory"])
+    if content["checkpoint"] is None:
+        return None
+    # Steps after the last checkpoint are dropped
+    del content["history"][n_history:]
+    del content["trajectory"][n_trajectory:]
+    return content
+
+
+def load_trajectory(path: Path) -> dict:
+    """Load a `.traj` file, falling back to its journal if the episode has not been compacted (yet)."""
+    path = Path(path)
+    if path.suffix == JOURNAL_SUFFIX and not path.exists():
+        # The episode has finished since the journal was listed
+        path = path.with_suffix(".traj")
+    if path.suffix != JOURNAL_SUFFIX and path.exists():
+        with path.open("r") as f:
+            return json.load(f)
+    return load_journal(path.with_suffix(JOURNAL_SUFFIX))
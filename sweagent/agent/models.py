@@ -1,3 +1,4 @@
+import asyncio
 import config
 import json
 import logging
@@ -5,11 +6,17 @@ import os
 import together
 
 from collections import defaultdict
-from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT
+from anthropic import Anthropic, AsyncAnthropic, HUMAN_PROMPT, AI_PROMPT
+from anthropic import RateLimitError as AnthropicRateLimitError
 from dataclasses import dataclass, fields
-from openai import BadRequestError, OpenAI, AzureOpenAI
+from openai import BadRequestError, OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
+from openai import RateLimitError as OpenAIRateLimitError
 from simple_parsing.helpers import FrozenSerializable, Serializable
 from sweagent.agent.commands import Command
+from sweagent.agent.parsing import FormatError
+from sweagent.agent.rate_limits import get_rate_limiter, get_retry_after
+from sweagent.agent.response_cache import ResponseCache, cached_response
+from sweagent.agent.tokens import FunctionTokenCounter, TiktokenCounter, TokenCounter
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -20,6 +27,9 @@ from typing import Optional
 
 logger = logging.getLogger("api_models")
 
+# Errors of the providers' SDKs for requests that exceeded a rate limit
+RATE_LIMIT_ERRORS = (OpenAIRateLimitError, AnthropicRateLimitError)
+
 
 @dataclass(frozen=True)
 class ModelArguments(FrozenSerializable):
@@ -30,6 +40,16 @@ class ModelArguments(FrozenSerializable):
     top_p: float = 1.0
     replay_path: str = None
     host_url: str = "localhost:11434"
+    prompt_caching: bool = False  # Use provider-side prompt caching for models that support it (changes billing)
+    stream: bool = False  # Stream responses and close the stream as soon as a complete action has arrived
+    response_cache_path: str = None  # SQLite file of a cache of responses that is shared by all runs using it
+    response_cache_max_mb: int = 1024  # Size of the response cache above which least recently used responses are evicted
+    response_cache_sampled: bool = False  # Also cache responses at a temperature > 0 (replaying them makes sampling deterministic)
+    requests_per_minute: int = 0  # Request rate limit of the model (0: unlimited), shared by all agents of the process
+    tokens_per_minute: int = 0  # Token rate limit of the model (0: unlimited), shared by all agents of the process
+    rate_limit_dir: str = None  # Directory with the state of the rate limits, to share them between processes
+    max_rate_limit_wait: float = 600  # Seconds a query waits after rate limit errors before failing
+    repair_model_name: str = None  # Cheaper model that is asked first to repair outputs with format or blocklist errors
 
 
 @dataclass
@@ -38,7 +58,11 @@ class APIStats(Serializable):
     instance_cost: float = 0
     tokens_sent: int = 0
     tokens_received: int = 0
+    tokens_cache_read: int = 0  # tokens of `tokens_sent` that were read from the provider's prompt cache
+    tokens_cache_write: int = 0  # tokens of `tokens_sent` that were written to the provider's prompt cache
     api_calls: int = 0
+    response_cache_hits: int = 0  # queries answered by the response cache (not included in `api_calls` and costs)
+    response_cache_saved_cost: float = 0  # original cost of the responses of `response_cache_hits`
 
     def __add__(self, other):
         if not isinstance(other, APIStats):
@@ -67,15 +91,142 @@ class CostLimitExceededError(Exception):
     pass
 
 
+# Errors that are not retried by the queries. Rate limit errors have already been retried by `send_request`
+# for up to `max_rate_limit_wait` seconds
+NO_RETRY_ERRORS = (CostLimitExceededError, ContextWindowExceededError, RuntimeError) + RATE_LIMIT_ERRORS
+
+
+class MessageCache:
+    """
+    Messages converted from the entries of a history. As long as the history holds the same entry (object)
+    at a position, its message is reused, so only new or replaced entries (e.g. entries that a history
+    processor omitted) are converted.
+    """
+    def __init__(self):
+        self.entries = []  # history entries that the messages were converted from
+        self.messages = []  # message per entry (None for entries that are not sent)
+
+    def update(self, history: list[dict[str, str]], convert) -> int:
+        """Convert new and replaced entries with `convert`, returns the position of the first changed entry"""
+        first_change = len(history)
+        del self.entries[len(history):]
+        del self.messages[len(history):]
+        for idx, entry in enumerate(history):
+            if idx < len(self.entries):
+                if self.entries[idx] is entry:
+                    continue
+                self.entries[idx] = entry
+                self.messages[idx] = convert(entry)
+            else:
+                self.entries.append(entry)
+                self.messages.append(convert(entry))
+            first_change = min(first_change, idx)
+        return first_change
+
+    def get_messages(self, history: list[dict[str, str]], convert) -> list[dict[str, str]]:
+        self.update(history, convert)
+        return [message for message in self.messages if message is not None]
+
+
+class MergedMessageCache(MessageCache):
+    """`MessageCache` that combines consecutive messages of the same role into one message."""
+    def __init__(self):
+        super().__init__()
+        self.merged = []  # combined messages
+        self.merged_start = []  # position of the first entry of each combined message
+
+    def get_messages(self, history: list[dict[str, str]], convert) -> list[dict[str, str]]:
+        first_change = self.update(history, convert)
+        # Drop the combined messages from the first changed entry on; the last remaining one is rebuilt
+        # as well, because it can continue with the changed (or new) entries
+        start = 0
+        while self.merged_start:
+            start = self.merged_start.pop()
+            self.merged.pop()
+            if start < first_change:
+                break
+        start = min(start, first_change)
+        for idx in range(start, len(self.messages)):
+            message = self.messages[idx]
+            if message is None:
+                continue
+            if self.merged and self.merged[-1]["role"] == message["role"]:
+                self.merged[-1] = {**self.merged[-1], "content": self.merged[-1]["content"] + "\n" + message["content"]}
+            else:
+                self.merged.append(message)
+                self.merged_start.append(idx)
+        return list(self.merged)
+
+    def n_messages_before(self, position: int) -> int:
+        """Number of combined messages (of the last `get_messages` call) that only contain entries before `position`"""
+        n = 0
+        while n < len(self.merged_start) and (
+            self.merged_start[n + 1] <= position if n + 1 < len(self.merged_start) else len(self.entries) <= position
+        ):
+            n += 1
+        return n
+
+
+class ResponseStream:
+    """
+    Text and usage of a streamed model response. With a parse function, the response is complete as soon as
+    it contains a complete and valid action, so the rest of the stream does not need to be read.
+    """
+    def __init__(self, parse_function=None, commands: Optional[list[Command]] = None):
+        self.parse_function = parse_function
+        self.commands = commands
+        self.action_stream = parse_function.action_stream() if parse_function is not None else None
+        self.chunks = []
+        self.complete = False  # the stream was closed after a complete action
+        # Usage as reported by the provider (None if the stream was closed before it was reported)
+        self.input_tokens = None
+        self.output_tokens = None
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def add(self, chunk: str) -> bool:
+        """Adds a chunk of text, returns True if the response contains a complete action"""
+        self.chunks.append(chunk)
+        end = self.action_stream.feed(chunk) if self.action_stream is not None else None
+        if end is None:
+            return False
+        text = self.text
+        try:
+            self.parse_function(text[:end], self.commands)
+        except FormatError:
+            return False
+        # Like a stop sequence, the response ends with the action
+        self.chunks[-1] = chunk[:len(chunk) - (len(text) - end)]
+        self.complete = True
+        return True
+
+
 class BaseModel:
     MODELS = {}
     SHORTCUTS = {}
+    message_cache_class = MessageCache
 
     def __init__(self, args: ModelArguments, commands: list[Command]):
         self.args = args
         self.commands = commands
+        self.parse_function = None  # set by the agent, used to close streamed responses early
         self.model_metadata = {}
         self.stats = APIStats()
+        self.token_counter = TokenCounter()  # subclasses use the tokenizer of their models
+        self.reset_message_cache()
+        self.rate_limiter = get_rate_limiter(
+            f"{self.__class__.__name__}:{args.model_name}",
+            args.requests_per_minute,
+            args.tokens_per_minute,
+            args.rate_limit_dir,
+        )
+        self.response_cache = None
+        if args.response_cache_path:
+            self.response_cache = ResponseCache(args.response_cache_path, args.response_cache_max_mb * 1024 ** 2)
 
         # Map `model_name` to API-compatible name `api_model`
         self.api_model = (
@@ -110,31 +261,50 @@ class BaseModel:
         else:
             self.stats = other
 
-    def update_stats(self, input_tokens, output_tokens):
+    def reset_message_cache(self):
+        """
+        Start new caches of converted messages and token counts (e.g. for a copy of the model that continues
+        another history)
+        """
+        self.message_cache = self.message_cache_class()
+        self.token_counter = self.token_counter.fresh_copy()
+
+    def update_stats(self, input_tokens, output_tokens, cache_read_tokens=0, cache_write_tokens=0):
         """
         Calculates the cost of a response from the openai API.
 
         Args:
-        input_tokens (int): The number of tokens in the prompt.
+        input_tokens (int): The number of tokens in the prompt (including cached tokens).
         output_tokens (int): The number of tokens in the response.
+        cache_read_tokens (int): The number of prompt tokens that were read from the prompt cache.
+        cache_write_tokens (int): The number of prompt tokens that were written to the prompt cache.
 
         Returns:
         float: The cost of the response.
         """
-        # Calculate cost and update cost related fields
+        # Calculate cost and update cost related fields, cached tokens are billed at their own rates
+        cost_per_input_token = self.model_metadata["cost_per_input_token"]
         cost = (
-            self.model_metadata["cost_per_input_token"] * input_tokens
+            cost_per_input_token * (input_tokens - cache_read_tokens - cache_write_tokens)
+            + self.model_metadata.get("cost_per_cache_read_token", cost_per_input_token) * cache_read_tokens
+            + self.model_metadata.get("cost_per_cache_write_token", cost_per_input_token) * cache_write_tokens
             + self.model_metadata["cost_per_output_token"] * output_tokens
         )
         self.stats.total_cost += cost
         self.stats.instance_cost += cost
         self.stats.tokens_sent += input_tokens
         self.stats.tokens_received += output_tokens
+        self.stats.tokens_cache_read += cache_read_tokens
+        self.stats.tokens_cache_write += cache_write_tokens
         self.stats.api_calls += 1
+        # The rate limiter only reserved the input tokens
+        self.rate_limiter.consume(output_tokens)
 
         # Log updated cost values to std. out.
         logger.info(
             f"input_tokens={input_tokens:_}, "
+            f"cache_read_tokens={cache_read_tokens:_}, "
+            f"cache_write_tokens={cache_write_tokens:_}, "
             f"output_tokens={output_tokens:_}, "
             f"instance_cost={self.stats.instance_cost:.2f}, "
             f"cost={cost:.2f}"
@@ -166,9 +336,134 @@ class BaseModel:
             raise CostLimitExceededError("Instance cost limit exceeded")
         return cost
 
+    def preflight(self, history: list[dict[str, str]]) -> None:
+        """
+        Checks a query with the locally counted tokens of `history` before it is sent. Raises an error if
+        the prompt does not fit into the context window, or if the cost of the prompt alone would exceed
+        a cost limit. Counts are taken as a lower bound, so valid queries are never rejected.
+        """
+        if "max_context" not in self.model_metadata:
+            return
+        input_tokens = self.token_counter.count_history(history)
+        min_input_tokens = int(input_tokens * (1 - self.token_counter.error_margin))
+        if min_input_tokens > self.model_metadata["max_context"]:
+            logger.warning(
+                f"Prompt of about {input_tokens:_} tokens exceeds context window of "
+                f"{self.model_metadata['max_context']:_} tokens"
+            )
+            raise ContextWindowExceededError(f"Context window ({self.model_metadata['max_context']} tokens) exceeded")
+        # Prompt tokens read from the prompt cache are the cheapest
+        cost_per_input_token = min(
+            self.model_metadata["cost_per_input_token"],
+            self.model_metadata.get("cost_per_cache_read_token", self.model_metadata["cost_per_input_token"]),
+        )
+        min_cost = cost_per_input_token * min_input_tokens
+        if self.args.total_cost_limit > 0 and self.stats.total_cost + min_cost >= self.args.total_cost_limit:
+            logger.warning(f"Prompt would exceed total cost limit {self.args.total_cost_limit:.2f}")
+            raise CostLimitExceededError("Total cost limit exceeded")
+        if self.args.per_instance_cost_limit > 0 and self.stats.instance_cost + min_cost >= self.args.per_instance_cost_limit:
+            logger.warning(f"Prompt would exceed instance cost limit {self.args.per_instance_cost_limit:.2f}")
+            raise CostLimitExceededError("Instance cost limit exceeded")
+
+    def send_request(self, history: list[dict[str, str]], function, *args, **kwargs):
+        """
+        Sends the request for `history` by calling `function` as soon as the rate limiter allows it.
+        After a rate limit error, the request is queued again instead of failing.
+        """
+        input_tokens = self.token_counter.count_history(history)
+        waited = attempt = 0
+        while True:
+            self.rate_limiter.acquire(input_tokens)
+            try:
+                return function(*args, **kwargs)
+            except RATE_LIMIT_ERRORS as e:
+                attempt += 1
+                waited += self.handle_rate_limit_error(e, attempt, waited)
+
+    async def asend_request(self, history: list[dict[str, str]], function, *args, **kwargs):
+        """Async version of `send_request` (`function` returns an awaitable)"""
+        input_tokens = self.token_counter.count_history(history)
+        waited = attempt = 0
+        while True:
+            await self.rate_limiter.aacquire(input_tokens)
+            try:
+                return await function(*args, **kwargs)
+            except RATE_LIMIT_ERRORS as e:
+                attempt += 1
+                waited += self.handle_rate_limit_error(e, attempt, waited)
+
+    def handle_rate_limit_error(self, error: Exception, attempt: int, waited: float) -> float:
+        """
+        Pauses the requests of the rate limiter as the provider asks for, returns the pause in seconds.
+        Reraises `error` if the quota is exhausted or the query has waited for too long.
+        """
+        if getattr(error, "code", None) == "insufficient_quota" or waited >= self.args.max_rate_limit_wait:
+            raise error
+        retry_after = get_retry_after(error, attempt)
+        logger.warning(f"Rate limit exceeded, retrying in {retry_after:.1f}s")
+        self.rate_limiter.pause(retry_after)
+        return retry_after
+
     def query(self, history: list[dict[str, str]]) -> str:
         raise NotImplementedError("Use a subclass of BaseModel")
 
+    async def aquery(self, history: list[dict[str, str]]) -> str:
+        """
+        Async version of `query` with the same stats, cost limits and retries. Models without an async client
+        run `query` in a worker thread.
+        """
+        return await asyncio.to_thread(self.query, history)
+
+    def read_chunk(self, response: ResponseStream, chunk) -> bool:
+        """Adds a chunk of a streamed API response to `response`, returns True if the stream can be closed"""
+        raise NotImplementedError(f"{self.__class__.__name__} does not support streaming")
+
+    def read_stream(self, stream, history: list[dict[str, str]]) -> str:
+        """Reads a streamed API response until it is complete, updates the stats and returns the text"""
+        response = ResponseStream(self.parse_function, self.commands)
+        try:
+            for chunk in stream:
+                if self.read_chunk(response, chunk):
+                    break
+        finally:
+            stream.close()
+        return self.finish_stream(response, history)
+
+    async def aread_stream(self, stream, history: list[dict[str, str]]) -> str:
+        """Async version of `read_stream`"""
+        response = ResponseStream(self.parse_function, self.commands)
+        try:
+            async for chunk in stream:
+                if self.read_chunk(response, chunk):
+                    break
+        finally:
+            close = getattr(stream, "aclose", None) or stream.close
+            await close()
+        return self.finish_stream(response, history)
+
+    def estimate_output_tokens(self, response: ResponseStream) -> int:
+        """Number of tokens of a response whose stream was closed early (providers stream one token per chunk)"""
+        return len(response.chunks)
+
+    def finish_stream(self, response: ResponseStream, history: list[dict[str, str]]) -> str:
+        """Updates the stats with the usage of a streamed response and returns its text"""
+        input_tokens, output_tokens = response.input_tokens, response.output_tokens
+        if response.complete:
+            logger.info("Closed the response stream after a complete action")
+        if input_tokens is None:
+            input_tokens = self.token_counter.count_history(history)
+            logger.info(f"Input tokens not reported by the closed stream, estimated {input_tokens:_}")
+        if output_tokens is None or response.complete:
+            # Usage reported at the start of the stream does not include the tokens generated after it
+            output_tokens = max(output_tokens or 0, self.estimate_output_tokens(response))
+        self.update_stats(
+            input_tokens,
+            output_tokens,
+            cache_read_tokens=response.cache_read_tokens,
+            cache_write_tokens=response.cache_write_tokens,
+        )
+        return response.text
+
 
 class OpenAIModel(BaseModel):
     MODELS = {
@@ -226,8 +521,11 @@ class OpenAIModel(BaseModel):
         if self.args.model_name.startswith("azure"):
             self.api_model = cfg["AZURE_OPENAI_DEPLOYMENT"]
             self.client = AzureOpenAI(api_key=cfg["AZURE_OPENAI_API_KEY"], azure_endpoint=cfg["AZURE_OPENAI_ENDPOINT"], api_version=cfg.get("AZURE_OPENAI_API_VERSION", "2024-02-01"))
+            self.async_client = AsyncAzureOpenAI(api_key=cfg["AZURE_OPENAI_API_KEY"], azure_endpoint=cfg["AZURE_OPENAI_ENDPOINT"], api_version=cfg.get("AZURE_OPENAI_API_VERSION", "2024-02-01"))
         else:
             self.client = OpenAI(api_key=cfg["OPENAI_API_KEY"])
+            self.async_client = AsyncOpenAI(api_key=cfg["OPENAI_API_KEY"])
+        self.token_counter = TiktokenCounter(model=self.api_model)
 
     def history_to_messages(
         self, history: list[dict[str, str]], is_demonstration: bool = False
@@ -240,35 +538,87 @@ class OpenAIModel(BaseModel):
             history = [entry for entry in history if entry["role"] != "system"]
             return '\n'.join([entry["content"] for entry in history])
         # Return history components with just role, content fields
-        return [
-            {k: v for k, v in entry.items() if k in ["role", "content"]}
-            for entry in history
-        ]
+        return self.message_cache.get_messages(
+            history,
+            lambda entry: {k: v for k, v in entry.items() if k in ["role", "content"]},
+        )
 
+    @cached_response
     @retry(
         wait=wait_random_exponential(min=1, max=15),
         reraise=True,
         stop=stop_after_attempt(3),
-        retry=retry_if_not_exception_type((CostLimitExceededError, RuntimeError)),
+        retry=retry_if_not_exception_type(NO_RETRY_ERRORS),
     )
     def query(self, history: list[dict[str, str]]) -> str:
         """
         Query the OpenAI API with the given `history` and return the response.
         """
+        self.preflight(history)
         try:
             # Perform OpenAI API call
-            response = self.client.chat.completions.create(
-                messages=self.history_to_messages(history),
-                model=self.api_model,
-                temperature=self.args.temperature,
-                top_p=self.args.top_p,
+            response = self.send_request(history, self.client.chat.completions.create, **self.get_request(history))
+        except BadRequestError as e:
+            raise CostLimitExceededError(f"Context window ({self.model_metadata['max_context']} tokens) exceeded")
+        if self.args.stream:
+            return self.read_stream(response, history)
+        return self.process_response(response)
+
+    @cached_response
+    @retry(
+        wait=wait_random_exponential(min=1, max=15),
+        reraise=True,
+        stop=stop_after_attempt(3),
+        retry=retry_if_not_exception_type(NO_RETRY_ERRORS),
+    )
+    async def aquery(self, history: list[dict[str, str]]) -> str:
+        """
+        Query the OpenAI API with the given `history` without blocking and return the response.
+        """
+        self.preflight(history)
+        try:
+            response = await self.asend_request(
+                history, self.async_client.chat.completions.create, **self.get_request(history),
             )
         except BadRequestError as e:
             raise CostLimitExceededError(f"Context window ({self.model_metadata['max_context']} tokens) exceeded")
+        if self.args.stream:
+            return await self.aread_stream(response, history)
+        return self.process_response(response)
+
+    def get_request(self, history: list[dict[str, str]]) -> dict:
+        """Arguments of the API call for `history`"""
+        request = {
+            "messages": self.history_to_messages(history),
+            "model": self.api_model,
+            "temperature": self.args.temperature,
+            "top_p": self.args.top_p,
+        }
+        if self.args.stream:
+            # The usage is sent in a last chunk after the content
+            request.update(stream=True, stream_options={"include_usage": True})
+        return request
+
+    def read_chunk(self, response: ResponseStream, chunk) -> bool:
+        if chunk.usage is not None:
+            response.input_tokens = chunk.usage.prompt_tokens
+            response.output_tokens = chunk.usage.completion_tokens
+            prompt_tokens_details = getattr(chunk.usage, "prompt_tokens_details", None)
+            response.cache_read_tokens = getattr(prompt_tokens_details, "cached_tokens", None) or 0
+        if chunk.choices and chunk.choices[0].delta.content:
+            return response.add(chunk.choices[0].delta.content)
+        return False
+
+    def process_response(self, response) -> str:
+        """Update the stats with the usage of `response` and return its content"""
         # Calculate + update costs, return response
         input_tokens = response.usage.prompt_tokens
         output_tokens = response.usage.completion_tokens
-        self.update_stats(input_tokens, output_tokens)
+        # Prompt caching is automatic for the models that support it. Cached tokens are only recorded: the models
+        # above have no cache pricing, so they are billed at the input rate
+        prompt_tokens_details = getattr(response.usage, "prompt_tokens_details", None)
+        cache_read_tokens = getattr(prompt_tokens_details, "cached_tokens", None) or 0
+        self.update_stats(input_tokens, output_tokens, cache_read_tokens=cache_read_tokens)
         return response.choices[0].message.content
 
 class AnthropicModel(BaseModel):
@@ -293,6 +643,9 @@ class AnthropicModel(BaseModel):
             "max_tokens": 4096,  # Max tokens to generate for Claude 3 models
             "cost_per_input_token": 1.5e-05,
             "cost_per_output_token": 7.5e-05,
+            # Models with cache costs support prompt caching
+            "cost_per_cache_read_token": 1.5e-06,
+            "cost_per_cache_write_token": 1.875e-05,
         },
         "claude-3-sonnet-20240229": {
             "max_context": 200_000,
@@ -305,6 +658,8 @@ class AnthropicModel(BaseModel):
             "max_tokens": 4096,
             "cost_per_input_token": 2.5e-07,
             "cost_per_output_token": 1.25e-06,
+            "cost_per_cache_read_token": 3e-08,
+            "cost_per_cache_write_token": 3e-07,
         },
     }
 
@@ -314,6 +669,8 @@ class AnthropicModel(BaseModel):
         "claude-sonnet": "claude-3-sonnet-20240229",
         "claude-haiku": "claude-3-haiku-20240307",
     }
+    message_cache_class = MergedMessageCache
+    PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
 
     def __init__(self, args: ModelArguments, commands: list[Command]):
         super().__init__(args, commands)
@@ -321,6 +678,31 @@ class AnthropicModel(BaseModel):
         # Set Anthropic key
         cfg = config.Config(os.path.join(os.getcwd(), "keys.cfg"))
         self.api = Anthropic(api_key=cfg["ANTHROPIC_API_KEY"])
+        self.async_api = AsyncAnthropic(api_key=cfg["ANTHROPIC_API_KEY"])
+        self.prompt_caching = self.args.prompt_caching and "cost_per_cache_read_token" in self.model_metadata
+        if self.api_model in ["claude-instant", "claude-2"]:
+            # The SDK comes with the tokenizer of older models
+            self.token_counter = FunctionTokenCounter(
+                self.api.count_tokens, tokens_per_message=self.api.count_tokens(f"{HUMAN_PROMPT} \n\n"),
+            )
+
+    def add_cache_breakpoints(self, history: list[dict[str, str]], messages: list[dict]) -> list[dict]:
+        """
+        Mark the prompt prefixes that the API caches: the last message that only holds the system message and
+        demonstrations (shared by all instances), and the last message (reused by the next query of the episode).
+        The system message itself is marked in `query`.
+        """
+        n_prefix = 0
+        while n_prefix < len(history) and (history[n_prefix]["role"] == "system" or history[n_prefix].get("is_demo", False)):
+            n_prefix += 1
+        breakpoints = {self.message_cache.n_messages_before(n_prefix) - 1, len(messages) - 1}
+        return [
+            {
+                **message,
+                "content": [{"type": "text", "text": message["content"], "cache_control": {"type": "ephemeral"}}],
+            } if idx in breakpoints else message
+            for idx, message in enumerate(messages)
+        ]
 
     def history_to_messages(
         self, history: list[dict[str, str]], is_demonstration: bool = False
@@ -349,45 +731,41 @@ class AnthropicModel(BaseModel):
             history = [entry for entry in history if entry["role"] != "system"]
             return '\n'.join([entry["content"] for entry in history])
 
-        # Return history components with just role, content fields (no system message)
-        messages = [
-            {
+        # Return history components with just role, content fields (no system message),
+        # messages from the same role are combined
+        messages = self.message_cache.get_messages(
+            history,
+            lambda entry: None if entry["role"] == "system" else {
                 k: v for k, v in entry.items()
                 if k in ["role", "content"]
-            }
-            for entry in history if entry["role"] != "system"
-        ]
-        compiled_messages = []  # Combine messages from the same role
-        last_role = None
-        for message in reversed(messages):
-            if last_role == message["role"]:
-                compiled_messages[-1]["content"] = message["content"] + "\n" + compiled_messages[-1]["content"]
-            else:
-                compiled_messages.append(message)
-            last_role = message["role"]
-        compiled_messages = list(reversed(compiled_messages))
+            },
+        )
         # Replace any empty content values with a "(No output)"
-        for message in compiled_messages:
-            if message["content"].strip() == "":
-                message["content"] = "(No output)"
-        return compiled_messages
+        return [
+            {**message, "content": "(No output)"} if message["content"].strip() == "" else message
+            for message in messages
+        ]
 
+    @cached_response
     @retry(
         wait=wait_random_exponential(min=1, max=15),
         reraise=True,
         stop=stop_after_attempt(3),
-        retry=retry_if_not_exception_type((CostLimitExceededError, RuntimeError)),
+        retry=retry_if_not_exception_type(NO_RETRY_ERRORS),
     )
     def query(self, history: list[dict[str, str]]) -> str:
         """
         Query the Anthropic API with the given `history` and return the response.
         """
+        self.preflight(history)
         # Preserve behavior for older models
         if self.api_model in ["claude-instant", "claude-2"]:
             # Perform Anthropic API call
             prompt = self.history_to_messages(history)
-            input_tokens = self.api.count_tokens(prompt)
-            completion = self.api.completions.create(
+            input_tokens = self.token_counter.count_history(history)
+            completion = self.send_request(
+                history,
+                self.api.completions.create,
                 model=self.api_model,
                 prompt=prompt,
                 max_tokens_to_sample=self.model_metadata["max_context"] - input_tokens,
@@ -396,33 +774,98 @@ class AnthropicModel(BaseModel):
             )
             # Calculate + update costs, return response
             response = completion.completion
-            output_tokens = self.api.count_tokens(response)
+            output_tokens = self.token_counter.count(response)
             self.update_stats(input_tokens, output_tokens)
             return response
 
+        # Perform Anthropic API call
+        response = self.send_request(history, self.api.messages.create, **self.get_request(history))
+        if self.args.stream:
+            return self.read_stream(response, history)
+        return self.process_response(response)
+
+    async def aquery(self, history: list[dict[str, str]]) -> str:
+        """
+        Query the Anthropic API with the given `history` without blocking and return the response.
+        """
+        if self.api_model in ["claude-instant", "claude-2"]:
+            # Legacy completions API (`query` retries by itself)
+            return await super().aquery(history)
+        return await self._aquery_messages(history)
+
+    @cached_response
+    @retry(
+        wait=wait_random_exponential(min=1, max=15),
+        reraise=True,
+        stop=stop_after_attempt(3),
+        retry=retry_if_not_exception_type(NO_RETRY_ERRORS),
+    )
+    async def _aquery_messages(self, history: list[dict[str, str]]) -> str:
+        self.preflight(history)
+        response = await self.asend_request(history, self.async_api.messages.create, **self.get_request(history))
+        if self.args.stream:
+            return await self.aread_stream(response, history)
+        return self.process_response(response)
+
+    def get_request(self, history: list[dict[str, str]]) -> dict:
+        """Arguments of the messages API call for `history`"""
         # Get system message(s)
         system_message = "\n".join([
             entry["content"] for entry in history if entry["role"] == "system"
         ])
         messages = self.history_to_messages(history)
-        # Perform Anthropic API call
-        response = self.api.messages.create(
-            messages=messages,
-            max_tokens=self.model_metadata["max_tokens"],
-            model=self.api_model,
-            temperature=self.args.temperature,
-            top_p=self.args.top_p,
-            system=system_message,
-        )
+        extra_headers = None
+        if self.prompt_caching:
+            messages = self.add_cache_breakpoints(history, messages)
+            system_message = [{"type": "text", "text": system_message, "cache_control": {"type": "ephemeral"}}]
+            extra_headers = {"anthropic-beta": self.PROMPT_CACHING_BETA}
+        return {
+            "messages": messages,
+            "max_tokens": self.model_metadata["max_tokens"],
+            "model": self.api_model,
+            "temperature": self.args.temperature,
+            "top_p": self.args.top_p,
+            "system": system_message,
+            "extra_headers": extra_headers,
+            "stream": self.args.stream,
+        }
 
+    def process_response(self, response) -> str:
+        """Update the stats with the usage of `response` and return its text"""
         # Calculate + update costs, return response
+        # (`input_tokens` only counts the tokens after the last cache breakpoint)
+        cache_read_tokens = getattr(response.usage, "cache_read_input_tokens", None) or 0
+        cache_write_tokens = getattr(response.usage, "cache_creation_input_tokens", None) or 0
         self.update_stats(
-            response.usage.input_tokens,
-            response.usage.output_tokens
+            response.usage.input_tokens + cache_read_tokens + cache_write_tokens,
+            response.usage.output_tokens,
+            cache_read_tokens=cache_read_tokens,
+            cache_write_tokens=cache_write_tokens,
         )
         response = "\n".join([x.text for x in response.content])
         return response
 
+    def read_chunk(self, response: ResponseStream, chunk) -> bool:
+        if chunk.type == "message_start":
+            # The input tokens are known from the start (`input_tokens` only counts the tokens after the last
+            # cache breakpoint)
+            usage = chunk.message.usage
+            response.cache_read_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+            response.cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+            response.input_tokens = usage.input_tokens + response.cache_read_tokens + response.cache_write_tokens
+            response.output_tokens = usage.output_tokens
+        elif chunk.type == "content_block_start" and chunk.index > 0:
+            return response.add("\n")
+        elif chunk.type == "content_block_delta" and chunk.delta.type == "text_delta":
+            return response.add(chunk.delta.text)
+        elif chunk.type == "message_delta":
+            response.output_tokens = chunk.usage.output_tokens
+        return False
+
+    def estimate_output_tokens(self, response: ResponseStream) -> int:
+        # Text deltas can hold several tokens
+        return self.token_counter.count(response.text)
+
 
 class OllamaModel(BaseModel):
     MODELS = defaultdict(lambda: {
@@ -433,8 +876,9 @@ class OllamaModel(BaseModel):
 
     def __init__(self, args: ModelArguments, commands: list[Command]):
         super().__init__(args, commands)
-        from ollama import Client
+        from ollama import AsyncClient, Client
         self.client = Client(host=args.host_url)
+        self.async_client = AsyncClient(host=args.host_url)
 
     def history_to_messages(
         self, history: list[dict[str, str]], is_demonstration: bool = False
@@ -447,29 +891,59 @@ class OllamaModel(BaseModel):
             history = [entry for entry in history if entry["role"] != "system"]
             return '\n'.join([entry["content"] for entry in history])
         # Return history components with just role, content fields
-        return [
-            {k: v for k, v in entry.items() if k in ["role", "content"]}
-            for entry in history
-        ]
+        return self.message_cache.get_messages(
+            history,
+            lambda entry: {k: v for k, v in entry.items() if k in ["role", "content"]},
+        )
 
+    @cached_response
     @retry(
         wait=wait_random_exponential(min=1, max=15),
         reraise=True,
         stop=stop_after_attempt(3),
-        retry=retry_if_not_exception_type((CostLimitExceededError, RuntimeError)),
+        retry=retry_if_not_exception_type(NO_RETRY_ERRORS),
     )
     def query(self, history: list[dict[str, str]]) -> str:
         """
         Query the Ollama API with the given `history` and return the response.
         """
-        response = self.client.chat(
-            model=self.api_model,
-            messages=self.history_to_messages(history),
-            options={
+        self.preflight(history)
+        response = self.send_request(history, self.client.chat, **self.get_request(history))
+        if self.args.stream:
+            return self.read_stream(response, history)
+        return self.process_response(response)
+
+    @cached_response
+    @retry(
+        wait=wait_random_exponential(min=1, max=15),
+        reraise=True,
+        stop=stop_after_attempt(3),
+        retry=retry_if_not_exception_type(NO_RETRY_ERRORS),
+    )
+    async def aquery(self, history: list[dict[str, str]]) -> str:
+        """
+        Query the Ollama API with the given `history` without blocking and return the response.
+        """
+        self.preflight(history)
+        response = await self.asend_request(history, self.async_client.chat, **self.get_request(history))
+        if self.args.stream:
+            return await self.aread_stream(response, history)
+        return self.process_response(response)
+
+    def get_request(self, history: list[dict[str, str]]) -> dict:
+        """Arguments of the chat API call for `history`"""
+        return {
+            "model": self.api_model,
+            "messages": self.history_to_messages(history),
+            "options": {
                 "temperature": self.args.temperature,
                 "top_p": self.args.top_p,
-            }
-        )
+            },
+            "stream": self.args.stream,
+        }
+
+    def process_response(self, response) -> str:
+        """Update the stats with the usage of `response` and return its content"""
         # Calculate + update costs, return response
         if "prompt_eval_count" in response:
             input_tokens = response["prompt_eval_count"]
@@ -485,6 +959,13 @@ class OllamaModel(BaseModel):
         self.update_stats(input_tokens, output_tokens)
         return response["message"]["content"]
 
+    def read_chunk(self, response: ResponseStream, chunk) -> bool:
+        if chunk.get("done"):
+            # The last chunk holds the usage
+            response.input_tokens = chunk.get("prompt_eval_count", 0)
+            response.output_tokens = chunk["eval_count"]
+        return response.add(chunk["message"]["content"])
+
 
 class TogetherModel(BaseModel):
     # Check https://docs.together.ai/docs/inference-models for model names, context
@@ -548,19 +1029,23 @@ class TogetherModel(BaseModel):
         prompt = f"{prompt}\n<bot>:"
         return prompt
 
+    @cached_response
     @retry(
         wait=wait_random_exponential(min=1, max=15),
         reraise=True,
         stop=stop_after_attempt(3),
-        retry=retry_if_not_exception_type((CostLimitExceededError, RuntimeError)),
+        retry=retry_if_not_exception_type(NO_RETRY_ERRORS),
     )
     def query(self, history: list[dict[str, str]]) -> str:
         """
         Query the Together API with the given `history` and return the response.
         """
+        self.preflight(history)
         # Perform Together API call
         prompt = self.history_to_messages(history)
-        completion = together.Complete.create(
+        completion = self.send_request(
+            history,
+            together.Complete.create,
             model=self.api_model,
             prompt=prompt,
             max_tokens=self.model_metadata["max_context"],
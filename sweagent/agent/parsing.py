@@ -7,12 +7,51 @@ import textwrap
 from abc import abstractmethod
 from dataclasses import dataclass
 from sweagent.agent.commands import Command
-from typing import List
+from typing import List, Optional
 
 
 class FormatError(Exception):
     pass
 
+
+class ActionStream:
+    """
+    Incremental check of a streamed model response for the end of the action. Parse functions return one
+    from `action_stream` if the first complete action of their format is the final one (e.g. the format asks for
+    a single, delimited command block). The response then ends there, as if it had been stopped by a stop sequence.
+    """
+    def __init__(self):
+        self.text = ""
+
+    def feed(self, chunk: str) -> Optional[int]:
+        """
+        Adds `chunk` to the response. Once the response contains a complete action, returns the length of the
+        response up to the end of the action (the rest of the chunk is dropped), otherwise None.
+        """
+        raise NotImplementedError
+
+
+class XMLCommandStream(ActionStream):
+    """
+    The action is complete once a </command> tag follows a <command> tag (like `XMLThoughtActionParser`).
+    Like a stop sequence, this ends the response after the first command block.
+    """
+    def __init__(self):
+        super().__init__()
+        self.search_start = 0  # position from which on the text is searched for the next </command> tag
+
+    def feed(self, chunk: str) -> Optional[int]:
+        self.text += chunk
+        end = self.text.find("</command>", self.search_start)
+        while end != -1:
+            if "<command>" in self.text[:end]:
+                return end + len("</command>")
+            self.search_start = end + len("</command>")
+            end = self.text.find("</command>", self.search_start)
+        # A tag can be split between chunks
+        self.search_start = max(self.search_start, len(self.text) - len("</command>") + 1)
+        return None
+
 # ABSTRACT BASE CLASSES
 
 class ParseFunctionMeta(type):
@@ -45,6 +84,14 @@ class ParseFunction(metaclass=ParseFunctionMeta):
         if self._error_message is None:
             raise NotImplementedError("You must define an error message for your parser.")
         return textwrap.dedent(self._error_message)
+
+    def action_stream(self) -> Optional[ActionStream]:
+        """
+        Returns an `ActionStream` that detects the end of the action in a streamed response, so that the
+        stream can be closed early. None if a later part of the response can still change the action (e.g.
+        the last of several code blocks is the action), then the stream is read until the end.
+        """
+        return None
     
     @classmethod
     def get(cls, name):
@@ -172,6 +219,10 @@ class XMLThoughtActionParser(ParseFunction):
         thought = model_response[:end_thought] + model_response[restart_thought:]
 
         return thought.strip(), action.strip()
+
+    def action_stream(self) -> Optional[ActionStream]:
+        # The format asks for a single command block, a streamed response ends with the first one
+        return XMLCommandStream()
     
 
 class EditFormat(ThoughtActionParser):
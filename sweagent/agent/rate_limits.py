@@ -0,0 +1,161 @@
+import asyncio
+import fcntl
+import json
+import logging
+import random
+import threading
+import time
+
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger("api_models")
+
+
+class RateLimiter:
+    """Client-side scheduler for the requests of a model that keeps within the rate limits of the provider.
+
+    Requests per minute and tokens per minute are limited with token buckets. A request reserves its share of
+    both buckets up front and waits until the buckets have refilled, so requests are served in the order in
+    which they arrived instead of failing and retrying all at once. A rate limit error of the provider pauses
+    all requests for the time given in its `Retry-After` header.
+
+    A limiter is shared by all models of the process with the same key (see `get_rate_limiter`). With a
+    `state_path`, the buckets are kept in that file and shared by all processes using it.
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0, state_path: Optional[Path] = None):
+        """
+        Args:
+            requests_per_minute: maximum number of requests per minute (0: unlimited)
+            tokens_per_minute: maximum number of tokens per minute (0: unlimited)
+            state_path: file that holds the state of the buckets for several processes
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.state_path = Path(state_path) if state_path is not None else None
+        if self.state_path is not None:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._state = self._initial_state()
+
+    def _initial_state(self) -> dict:
+        # Buckets start full, their levels can become negative (requests that have to wait)
+        return {
+            "requests": self.requests_per_minute,
+            "tokens": self.tokens_per_minute,
+            "updated": time.time(),
+            "paused_until": 0.0,
+        }
+
+    def _update(self, update) -> float:
+        """Applies `update` to the refilled state (in the state file, if any), returns its return value"""
+        with self._lock:
+            if self.state_path is None:
+                self._refill(self._state)
+                return update(self._state)
+            with self.state_path.open("a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    state = json.loads(content) if content else self._initial_state()
+                    self._refill(state)
+                    result = update(state)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            return result
+
+    def _refill(self, state: dict) -> None:
+        now = time.time()
+        elapsed_minutes = max(0.0, now - state["updated"]) / 60
+        state["requests"] = min(self.requests_per_minute, state["requests"] + elapsed_minutes * self.requests_per_minute)
+        state["tokens"] = min(self.tokens_per_minute, state["tokens"] + elapsed_minutes * self.tokens_per_minute)
+        state["updated"] = now
+
+    def reserve(self, tokens: int) -> float:
+        """Reserves a request with `tokens` tokens, returns the number of seconds to wait before sending it"""
+        def update(state):
+            wait = max(0.0, state["paused_until"] - state["updated"])
+            if self.requests_per_minute > 0:
+                state["requests"] -= 1
+                wait = max(wait, -state["requests"] / self.requests_per_minute * 60)
+            if self.tokens_per_minute > 0:
+                # A request with more tokens than the limit would never fit, it waits for a full bucket
+                state["tokens"] -= min(tokens, self.tokens_per_minute)
+                wait = max(wait, -state["tokens"] / self.tokens_per_minute * 60)
+            return wait
+        return self._update(update)
+
+    def consume(self, tokens: int) -> None:
+        """Takes tokens that were not reserved (e.g. the output of a response) from the bucket"""
+        if self.tokens_per_minute <= 0 or tokens <= 0:
+            return
+
+        def update(state):
+            state["tokens"] -= min(tokens, self.tokens_per_minute)
+        self._update(update)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back all requests for `seconds` (after a rate limit error of the provider)"""
+        def update(state):
+            state["paused_until"] = max(state["paused_until"], state["updated"] + seconds)
+        self._update(update)
+
+    def acquire(self, tokens: int) -> None:
+        """Waits until a request with `tokens` tokens may be sent"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            logger.info(f"Waiting {wait:.1f}s for the rate limit")
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int) -> None:
+        """Async version of `acquire`"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            logger.info(f"Waiting {wait:.1f}s for the rate limit")
+            await asyncio.sleep(wait)
+
+
+def get_retry_after(error: Exception, attempt: int) -> float:
+    """
+    Seconds to wait after a rate limit error, from the `retry-after-ms` or `retry-after` header of its
+    response, or exponential backoff with jitter for the `attempt`-th error in a row.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for header, factor in [("retry-after-ms", 1 / 1000), ("retry-after", 1)]:
+        try:
+            return float(headers[header]) * factor
+        except (KeyError, TypeError, ValueError):
+            continue
+    return random.uniform(0, min(60, 2 ** attempt))
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str, requests_per_minute: int = 0, tokens_per_minute: int = 0, state_dir: Optional[str] = None) -> RateLimiter:
+    """
+    Returns the rate limiter of the process for `key` (e.g. the provider and model), created on first use.
+    The limits of the provider apply to all users of the model, so later callers share the limiter and its limits.
+    """
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            state_path = None
+            if state_dir:
+                state_path = Path(state_dir) / (key.replace("/", "_").replace(":", "_") + ".json")
+            _rate_limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute, state_path)
+        rate_limiter = _rate_limiters[key]
+        if (rate_limiter.requests_per_minute, rate_limiter.tokens_per_minute) != (requests_per_minute, tokens_per_minute):
+            logger.warning(
+                f"Rate limiter {key} already limits to {rate_limiter.requests_per_minute} requests and "
+                f"{rate_limiter.tokens_per_minute} tokens per minute, ignoring the limits of {requests_per_minute} "
+                f"requests and {tokens_per_minute} tokens per minute"
+            )
+        return rate_limiter
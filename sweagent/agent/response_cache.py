@@ -0,0 +1,147 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger("api_models")
+
+
+class ResponseCache:
+    """Content-addressed cache of model responses in a SQLite file.
+
+    Responses are stored under a hash of everything that determines them (model, messages, sampling
+    parameters), so re-running a configuration does not pay for the same queries again. The file can be
+    shared by several worker processes. Once it holds more than `max_size` bytes of responses, the least
+    recently used ones are evicted.
+    """
+
+    def __init__(self, path: Path, max_size: int):
+        """
+        Args:
+            path: path of the SQLite file
+            max_size: maximum total size of the cached responses in bytes
+        """
+        self.path = Path(path)
+        self.max_size = max_size
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Other processes can hold the write lock for a moment, so wait for it instead of failing
+        self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, cost REAL NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    @staticmethod
+    def get_key(api_model: str, history: list[dict[str, str]], temperature: float, top_p: float, max_tokens: Optional[int]) -> str:
+        """Hash of a query, the history is normalized to the role and content of its entries"""
+        query = {
+            "api_model": api_model,
+            "messages": [{"role": entry["role"], "content": entry["content"]} for entry in history],
+            "temperature": temperature,
+            "top_p": top_p,
+            "max_tokens": max_tokens,
+        }
+        return hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[tuple[str, float]]:
+        """Returns the response and its original cost, None if `key` is not cached"""
+        with self._lock:
+            row = self._connection.execute("SELECT response, cost FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def put(self, key: str, response: str, cost: float) -> None:
+        size = len(response.encode())
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, cost, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, response, cost, size, time.time()),
+                )
+                self._evict()
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _evict(self) -> None:
+        """Remove the least recently used responses until the total size is below `max_size`"""
+        excess = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logger.info(f"Evicted {len(evicted)} responses from the response cache")
+
+
+def cached_response(query):
+    """
+    Decorator for `query` and `aquery` of models: returns the cached response if the model has a response
+    cache that holds one for the history, otherwise queries the model and caches its response.
+    Responses sampled at a temperature > 0 are only cached with `response_cache_sampled`, since replaying them
+    makes the sampling deterministic.
+    Cache hits do not count as API calls or cost, they are counted in `response_cache_hits` and
+    `response_cache_saved_cost` of the stats.
+    """
+    def use_cache(model) -> bool:
+        return model.response_cache is not None and (model.args.temperature == 0 or model.args.response_cache_sampled)
+
+    def get_cached(model, history):
+        key = ResponseCache.get_key(
+            model.api_model,
+            history,
+            model.args.temperature,
+            model.args.top_p,
+            model.model_metadata.get("max_tokens"),
+        )
+        cached = model.response_cache.get(key)
+        if cached is not None:
+            response, cost = cached
+            model.stats.response_cache_hits += 1
+            model.stats.response_cache_saved_cost += cost
+            logger.info(f"Using cached response (saved cost={cost:.2f})")
+        return key, cached
+
+    if asyncio.iscoroutinefunction(query):
+        @functools.wraps(query)
+        async def wrapper(model, history):
+            if not use_cache(model):
+                return await query(model, history)
+            key, cached = get_cached(model, history)
+            if cached is not None:
+                return cached[0]
+            cost = model.stats.instance_cost
+            response = await query(model, history)
+            model.response_cache.put(key, response, model.stats.instance_cost - cost)
+            return response
+    else:
+        @functools.wraps(query)
+        def wrapper(model, history):
+            if not use_cache(model):
+                return query(model, history)
+            key, cached = get_cached(model, history)
+            if cached is not None:
+                return cached[0]
+            cost = model.stats.instance_cost
+            response = query(model, history)
+            model.response_cache.put(key, response, model.stats.instance_cost - cost)
+            return response
+    return wrapper
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+
+from abc import abstractmethod
+from pathlib import Path
+from sweagent.agent.agents import Agent
+from sweagent.agent.models import APIStats
+from sweagent.environment.swe_env import SWEEnv
+from sweagent.environment.utils import LOGGER_NAME, copy_file_to_container
+from typing import Optional
+
+logger = logging.getLogger(LOGGER_NAME)
+
+PATH_TO_ROLLOUT_PATCH = "/root/rollout.patch"
+
+
+class RolloutScorerMeta(type):
+    _registry = {}
+
+    def __new__(cls, name, bases, attrs):
+        new_cls = super().__new__(cls, name, bases, attrs)
+        if name != "RolloutScorer":
+            cls._registry[name] = new_cls
+        return new_cls
+
+
+class RolloutScorer(metaclass=RolloutScorerMeta):
+    """Scores the outcome of a rollout, the rollout with the highest score is selected."""
+
+    @abstractmethod
+    def __call__(self, info: dict, env: SWEEnv) -> float:
+        """
+        Args:
+            info: info returned by `Agent.run` for the rollout
+            env: environment in the prepared state (before any rollout ran)
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def get(cls, name, *args, **kwargs):
+        try:
+            return cls._registry[name](*args, **kwargs)
+        except KeyError:
+            raise ValueError(f"Rollout scorer ({name}) not found.")
+
+
+# DEFINE NEW ROLLOUT SCORERS BELOW THIS LINE
+
+class NonEmptyPatchScorer(RolloutScorer):
+    """1 for a non-empty submission, 0 otherwise"""
+
+    def __call__(self, info, env):
+        return float(bool((info.get("submission") or "").strip()))
+
+
+class AppliedPatchScorer(NonEmptyPatchScorer):
+    """
+    Prefers submissions that apply to the repository in the prepared state (+1) and that were submitted
+    by the agent rather than autosubmitted when the episode was cut short (+0.5).
+    """
+
+    def __call__(self, info, env):
+        score = super().__call__(info, env)
+        if score == 0:
+            return score
+        copy_file_to_container(env.container_obj, info["submission"], PATH_TO_ROLLOUT_PATCH)
+        env.communicate(f"git apply --check {PATH_TO_ROLLOUT_PATCH}")
+        if env.returncode == 0:
+            score += 1
+        env.communicate(f"rm -f {PATH_TO_ROLLOUT_PATCH}")
+        if info.get("exit_status") == "submitted":
+            score += 0.5
+        return score
+
+
+def run_rollouts(
+        agent: Agent,
+        env: SWEEnv,
+        n: int,
+        scorer: RolloutScorer,
+        setup_args: dict,
+        observation: Optional[str],
+        traj_dir: Path,
+        traj_fsync_every: int = 0,
+    ) -> tuple[dict, list]:
+    """
+    Run `n` episodes of `agent` concurrently, each in its own fork of `env` (which has been reset to the
+    task instance, so setup and installation are shared), and select the one with the highest score
+    (ties go to the first rollout).
+
+    The trajectory of every rollout is saved to `traj_dir/rollout_<i>`, the selected one is also saved to
+    `traj_dir`. The model stats of `agent` and `info["model_stats"]` account for all rollouts.
+
+    Returns:
+        info and trajectory of the selected rollout (`info["rollouts"]` lists exit status and score of all rollouts)
+    """
+    envs = env.fork_many(n)
+    agents = [agent.fork() for _ in range(n)]
+
+    async def run_all():
+        runs = list()
+        for i in range(n):
+            rollout_dir = traj_dir / f"rollout_{i}"
+            rollout_dir.mkdir(parents=True, exist_ok=True)
+            runs.append(agents[i].arun(
+                setup_args=setup_args,
+                env=envs[i],
+                observation=observation,
+                traj_dir=rollout_dir,
+                return_type="info_trajectory",
+                traj_fsync_every=traj_fsync_every,
+            ))
+        return await asyncio.gather(*runs, return_exceptions=True)
+
+    results = list()
+    try:
+        for i, result in enumerate(asyncio.run(run_all())):
+            if isinstance(result, Exception):
+                logger.warning(f"❌ Rollout {i} failed: {result}")
+                result = None
+            results.append(result)
+    finally:
+        for rollout_env in envs:
+            rollout_env.close()
+        # All forks share the committed image
+        envs[0].remove_fork_image()
+
+    rollouts = list()
+    best = None
+    for i, result in enumerate(results):
+        if result is None:
+            rollouts.append({"exit_status": "rollout_failed", "score": None})
+            continue
+        info, _ = result
+        score = scorer(info, env)
+        rollouts.append({"exit_status": info.get("exit_status"), "score": score})
+        if best is None or score > rollouts[best]["score"]:
+            best = i
+    logger.info(f"Rollout scores: {json.dumps([rollout['score'] for rollout in rollouts])}")
+
+    # All rollouts count towards the cost of the instance
+    stats = APIStats()
+    for rollout_agent in agents:
+        stats = stats + rollout_agent.model.stats
+    # Every rollout started from the total cost of `agent`
+    stats.total_cost = agent.model.stats.total_cost + stats.instance_cost
+    agent.model.stats = stats
+
+    if best is None:
+        raise RuntimeError("All rollouts failed")
+    info, trajectory = results[best]
+    info["rollouts"] = rollouts
+    info["selected_rollout"] = best
+    info["model_stats"] = stats.to_dict()
+    agents[best].save_trajectory(trajectory, traj_dir, env, info)
+    return info, trajectory
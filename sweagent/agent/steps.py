@@ -0,0 +1,85 @@
+import asyncio
+
+from typing import Any, Generator
+
+# Generator that yields the requests below and returns the result of an episode (or a part of it)
+Steps = Generator[Any, Any, Any]
+
+
+class ModelQuery:
+    """Query of a model with a history"""
+
+    def __init__(self, model, history: list[dict[str, str]]):
+        self.model = model
+        self.history = history
+
+    def run(self) -> str:
+        return self.model.query(self.history)
+
+    async def arun(self) -> str:
+        return await self.model.aquery(self.history)
+
+
+class BlockingCall:
+    """Call of a function that blocks, e.g. a command in the environment (run in a worker thread by `arun_steps`)"""
+
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def run(self) -> Any:
+        return self.function(*self.args, **self.kwargs)
+
+    async def arun(self) -> Any:
+        return await asyncio.to_thread(self.function, *self.args, **self.kwargs)
+
+
+class AgentRun:
+    """Episode of another agent (e.g. of a subroutine)"""
+
+    def __init__(self, agent, **kwargs):
+        self.agent = agent
+        self.kwargs = kwargs
+
+    def run(self) -> Any:
+        return self.agent.run(**self.kwargs)
+
+    async def arun(self) -> Any:
+        return await self.agent.arun(**self.kwargs)
+
+
+def run_steps(steps: Steps) -> Any:
+    """
+    Run the requests yielded by `steps` one after another and send their results back (exceptions are
+    raised inside of `steps`). Returns the return value of `steps`.
+    """
+    result, error = None, None
+    while True:
+        try:
+            request = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+        result, error = None, None
+        try:
+            result = request.run()
+        except Exception as e:
+            error = e
+
+
+async def arun_steps(steps: Steps) -> Any:
+    """
+    Async version of `run_steps`: model queries use the async clients of the models and blocking calls run in
+    worker threads, so many episodes can run concurrently in one event loop.
+    """
+    result, error = None, None
+    while True:
+        try:
+            request = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+        result, error = None, None
+        try:
+            result = await request.arun()
+        except Exception as e:
+            error = e
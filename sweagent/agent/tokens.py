@@ -0,0 +1,96 @@
+import copy
+
+from typing import Callable, Optional
+
+
+class TokenCounter:
+    """
+    Counts the tokens of a history locally. The counts of entries are cached, as long as the history holds
+    the same entry (object) at a position, it is not counted again.
+
+    The base class estimates tokens from the number of characters, subclasses use the tokenizer of the model.
+    """
+    chars_per_token = 4  # used to estimate token counts
+    tokens_per_message = 4  # overhead of the message format
+    error_margin = 0.25  # relative error of the counts (used for checks that must not reject valid requests)
+
+    def __init__(self):
+        self._entries = []  # history entries that were counted
+        self._counts = []  # token count of each entry
+
+    def count(self, text: str) -> int:
+        return len(text) // self.chars_per_token + 1
+
+    def count_entry(self, entry: dict[str, str]) -> int:
+        return self.count(entry["content"]) + self.tokens_per_message
+
+    def count_history(self, history: list[dict[str, str]]) -> int:
+        del self._entries[len(history):]
+        del self._counts[len(history):]
+        for idx, entry in enumerate(history):
+            if idx < len(self._entries):
+                if self._entries[idx] is entry:
+                    continue
+                self._entries[idx] = entry
+                self._counts[idx] = self.count_entry(entry)
+            else:
+                self._entries.append(entry)
+                self._counts.append(self.count_entry(entry))
+        return sum(self._counts)
+
+    def fresh_copy(self) -> "TokenCounter":
+        """Returns a counter with the same tokenizer and an empty cache (e.g. for another history)"""
+        counter = copy.copy(self)
+        counter._entries = []
+        counter._counts = []
+        return counter
+
+
+class TiktokenCounter(TokenCounter):
+    """Counts tokens with `tiktoken` (OpenAI models), falls back to estimates if it is not installed"""
+
+    def __init__(self, encoding: str = "cl100k_base", model: Optional[str] = None):
+        """
+        Args:
+            encoding: `tiktoken` encoding used if `model` is unset or unknown to `tiktoken`
+            model: name of the model whose encoding is used
+        """
+        super().__init__()
+        self.encoding = encoding
+        self.model = model
+        self._tokenizer = None
+
+    def _get_tokenizer(self):
+        if self._tokenizer is None:
+            try:
+                import tiktoken
+            except ImportError:
+                self._tokenizer = False
+                return self._tokenizer
+            try:
+                self._tokenizer = tiktoken.encoding_for_model(self.model).encode if self.model else None
+            except KeyError:
+                pass
+            if self._tokenizer is None:
+                self._tokenizer = tiktoken.get_encoding(self.encoding).encode
+            self.error_margin = 0.01
+        return self._tokenizer
+
+    def count(self, text: str) -> int:
+        tokenizer = self._get_tokenizer()
+        if tokenizer:
+            return len(tokenizer(text, disallowed_special=()))
+        return super().count(text)
+
+
+class FunctionTokenCounter(TokenCounter):
+    """Counts tokens with a function, e.g. the tokenizer that comes with the SDK of a provider"""
+    error_margin = 0.01
+
+    def __init__(self, count_function: Callable[[str], int], tokens_per_message: int = TokenCounter.tokens_per_message):
+        super().__init__()
+        self.count_function = count_function
+        self.tokens_per_message = tokens_per_message
+
+    def count(self, text: str) -> int:
+        return self.count_function(text)
@@ -1,12 +1,15 @@
+import copy
 import random
 import config
 import datetime
 import docker
 import gymnasium as gym
 import hashlib
+import json
 import logging
 import os
 import re
+import shlex
 import subprocess
 import traceback
 import time
@@ -25,6 +28,7 @@ from sweagent.environment.utils import (
     is_from_github_url,
     parse_gh_issue_url,
     parse_gh_repo_url,
+    read_file_from_container,
     read_with_timeout,
     LOGGER_NAME,
 )
@@ -38,6 +42,25 @@ from typing import Optional, Tuple
 LONG_TIMEOUT = 500
 PATH_TO_REQS = "/root/requirements.txt"
 PATH_TO_ENV_YML = "/root/environment.yml"
+PATH_TO_WORKSPACE = "/workspace"
+PATH_TO_CONDA_ENVS = "/root/miniconda3/envs"
+PATH_TO_SHELL_STATE = "/root/.fork_shell_state.sh"
+PATH_TO_PACKAGE_MIRROR = "/root/package_mirror"
+# Commands write large outputs (e.g. the submitted patch) here and print `artifact:<name>` instead
+PATH_TO_ARTIFACTS = "/root/artifacts"
+ARTIFACT_PREFIX = "artifact:"
+PATH_TO_CHECKPOINT_INDEX = "/root/.checkpoint_index"
+PATH_TO_CHECKPOINT_PATCH = "/root/checkpoint.patch"
+STATE_TRAILER_START = "<<STATE||"
+STATE_TRAILER_END = "||STATE>>"
+# Stored inside the (activated) conda environment, so they disappear together with it
+PATH_TO_INSTALL_FINGERPRINT = "$CONDA_PREFIX/.swe_install_fingerprint"
+PATH_TO_INSTALL_ARTIFACTS = "$CONDA_PREFIX/.swe_install_artifacts.tar"
+# Files that can change the result of an editable install (in any directory of the repository)
+BUILD_FILES = [
+    "setup.py", "setup_package.py", "setup.cfg", "pyproject.toml", "MANIFEST.in",
+    "*.c", "*.h", "*.cpp", "*.pyx", "*.pxd", "*.pxi", "*.f", "*.f90", "*.cu",
+]
 
 handler = RichHandler(show_time=False, show_path=False)
 handler.setLevel(logging.DEBUG)
@@ -58,6 +81,13 @@ class EnvironmentArguments(FrozenSerializable):
     timeout: int = 35
     verbose: bool = False
     no_mirror: bool = False
+    workspace_tmpfs_size: Optional[str] = None  # e.g. "8g": work on a copy of the repository in a tmpfs of this size
+    # e.g. "16g": keep conda environments in a tmpfs of this size. The tmpfs starts empty and hides environments that
+    # are part of the image, install_environment creates them again in the tmpfs
+    conda_tmpfs_size: Optional[str] = None
+    package_mirror: Optional[str] = None  # host directory with pip/conda packages (see make_package_mirror.py)
+    offline: bool = False  # only install packages from package_mirror
+    skip_redundant_install: bool = False  # skip installing the repo if the install fingerprint is unchanged
 
 
 class SWEEnv(gym.Env):
@@ -74,6 +104,7 @@ class SWEEnv(gym.Env):
         self.install_environment = args.install_environment
         self.logger = logger
         self.persistent = args.container_name is not None
+        self.is_fork = False
         self.returncode = None
         self.is_from_github_url = is_from_github_url(args.data_path)
         if not self.args.verbose:
@@ -159,11 +190,15 @@ class SWEEnv(gym.Env):
                     error_msg="Failed to clone repository from non-mirror",
                     timeout_duration=LONG_TIMEOUT,
                 )
+        repo_path = repo_name
+        if self.args.workspace_tmpfs_size is not None:
+            repo_path = self._seed_workspace(repo_name)
 
         # Clean repository of any modifications + Checkout base commit
         for cmd in [
             "echo -n > /root/files_to_edit.txt",
-            f"cd {repo_name}",
+            f"rm -rf {PATH_TO_ARTIFACTS} && mkdir -p {PATH_TO_ARTIFACTS}",
+            f"cd {repo_path}",
             "export ROOT=$(pwd -P)",
             "git status",
             "git restore .",
@@ -198,7 +233,7 @@ class SWEEnv(gym.Env):
         arch = self.communicate("uname -m").strip().lower()
         if system == 'linux' and arch == 'x86_64':
             self.communicate_with_handling(
-                f"apt update; apt install build-essential -y",
+                "apt update; apt install build-essential -y",
                 error_msg="Failed to install build-essential",
                 timeout_duration=LONG_TIMEOUT,
                 )
@@ -237,12 +272,14 @@ class SWEEnv(gym.Env):
         # Write any metadata to info if necessary
         return None, info
 
-    def step(self, action: str) -> Tuple[str, int, bool, dict]:
+    def step(self, action: str, state_command: Optional[str] = None) -> Tuple[str, int, bool, dict]:
         """
         Runs given action in environment and returns corresponding output
 
         Args:
             action (`str`) - command to run in bash shell
+            state_command (`str`) - if given, the command is run after the action (in the same round trip)
+                and its output is returned as `info["state"]`
 
         Returns:
             observation (`str`) - output from container
@@ -258,7 +295,7 @@ class SWEEnv(gym.Env):
             observation = "Skipped"
             info["exit_status"] = "skipped"
             return observation, 0, True, info
-        if action in {"exit_context", "exit_cost", "exit_error", "exit_format", "exit_api"}:
+        if action in {"exit_context", "exit_cost", "exit_error", "exit_format", "exit_api", "exit_loop"}:
             try:
                 observation = self.communicate(input="submit")
                 submission = self.get_submission('submit', observation)
@@ -279,7 +316,19 @@ class SWEEnv(gym.Env):
         # Attempt to run action in container
         observation = ""
         try:
-            observation = self.communicate(input=action, timeout_duration=25)
+            if state_command is not None and action.strip() != "exit":
+                # The syntax check sees the action as it is, so that its errors are the same as without trailer
+                observation, valid = self._check_syntax(action)
+                if valid:
+                    observation = self._communicate(
+                        self._add_state_trailer(action, state_command), timeout_duration=25,
+                    )
+                    observation, state = self._split_state_trailer(observation)
+                    self.communicate_output = observation
+                    if state is not None:
+                        info["state"] = state
+            else:
+                observation = self.communicate(input=action, timeout_duration=25)
         except TimeoutError:
             try:
                 self.interrupt()
@@ -311,10 +360,35 @@ class SWEEnv(gym.Env):
             self.logger.info(f"Found submission: {submission}")
             info["exit_status"] = "submitted"
             info["submission"] = submission if submission.strip() != "" else None
-            observation = submission if submission.strip() != "" else None
+            observation = f"Submitted patch ({len(submission.splitlines())} lines)" if submission.strip() != "" else None
             return observation, 0, True, info
         return observation, 0, False, info
 
+    def _add_state_trailer(self, action: str, state_command: str) -> str:
+        """
+        Appends `state_command` to `action` (which has passed the syntax check) so that its output follows the
+        output of the action, framed by `STATE_TRAILER_START` and `STATE_TRAILER_END`.
+        The exit code of the action is kept and the variable that holds it is removed again.
+        """
+        # The empty line ends a trailing line continuation of the action
+        return (
+            f"{action}\n\n"
+            f"__state_rc=$?; printf '\\n{STATE_TRAILER_START}'; {state_command}; printf '{STATE_TRAILER_END}\\n'; "
+            'eval "unset __state_rc; (exit $__state_rc)"'
+        )
+
+    def _split_state_trailer(self, output: str) -> Tuple[str, Optional[str]]:
+        """
+        Splits the output of an action with state trailer into the output of the action and the state
+        (None if the output has no trailer, e.g. because of a syntax error)
+        """
+        start = output.rfind(f"\n{STATE_TRAILER_START}")
+        end = output.rfind(STATE_TRAILER_END)
+        if start == -1 or end < start:
+            return output, None
+        state = output[start + len(STATE_TRAILER_START) + 1:end].strip()
+        return output[:start] + output[end + len(STATE_TRAILER_END):].lstrip("\n"), state
+
     def close(self):
         """
         Handle environment shutdown
@@ -342,6 +416,99 @@ class SWEEnv(gym.Env):
                 pass
             self.logger.info("Agent container stopped")
 
+    def remove_fork_image(self):
+        """
+        Remove the committed image of a forked environment. Called by the owner of the forks once all of them
+        have been closed (`close` keeps the image, because `reset_container` restarts the fork from it).
+        """
+        if not self.is_fork:
+            return
+        try:
+            docker.from_env().images.remove(self.image_name, force=True)
+        except KeyboardInterrupt:
+            raise
+        except:
+            pass
+
+    def fork(self) -> "SWEEnv":
+        """
+        Clones the current state of the environment into a new environment (with its own container), so that
+        an episode can be continued along several branches without re-executing earlier steps.
+        * Snapshots shell variables, functions and the working directory to a file
+        * Copies the contents of tmpfs mounts (not captured by `docker commit`) to the container file system
+        * Commits the container to an image and starts a new (non-persistent) container from it
+        * Restores tmpfs contents and shell state in the new container
+        Once the fork is closed, the committed image is removed with `remove_fork_image`.
+
+        Returns:
+            env (`SWEEnv`) - forked environment, positioned at the same task instance
+        """
+        return self.fork_many(1)[0]
+
+    def fork_many(self, n: int) -> list["SWEEnv"]:
+        """
+        Clones the current state of the environment into `n` new environments (see `fork`).
+        The container is only committed once, all forks start from the same image. Once all forks are closed,
+        remove it with `remove_fork_image` of any of them.
+
+        Args:
+            n (`int`) - number of forks
+
+        Returns:
+            envs (`list[SWEEnv]`) - forked environments, positioned at the same task instance
+        """
+        self.communicate_with_handling(
+            input=(
+                f"{{ declare -p | grep -v '^declare -[a-zA-Z]*r'; declare -f; printf 'cd %q\\n' \"$PWD\"; }}"
+                f" > {PATH_TO_SHELL_STATE}"
+            ),
+            error_msg="Failed to save shell state",
+        )
+        tmpfs_archives = {
+            path: f"/root/.fork_{path.strip('/').replace('/', '_')}.tar"
+            for path in self._get_tmpfs_mounts()
+        }
+        for path, archive in tmpfs_archives.items():
+            self.communicate_with_handling(
+                input=f"tar -C {path} -cf {archive} .",
+                error_msg=f"Failed to archive tmpfs mount {path}",
+                timeout_duration=LONG_TIMEOUT,
+            )
+        image = self.container_obj.commit()
+        self.communicate(f"rm -f {PATH_TO_SHELL_STATE} {' '.join(tmpfs_archives.values())}")
+        self.logger.info(f"Committed container {self.container_name} to image {image.id}")
+
+        envs = list()
+        try:
+            for _ in range(n):
+                env = copy.copy(self)
+                env.image_name = image.id
+                env.container_name = None
+                env.persistent = False
+                # The committed image is removed by the owner of the forks (`remove_fork_image`)
+                env.is_fork = True
+                envs.append(env)
+                env._init_container()
+                env._init_scripts()
+                for path, archive in tmpfs_archives.items():
+                    env.communicate_with_handling(
+                        input=f"tar -C {path} -xf {archive} && rm {archive}",
+                        error_msg=f"Failed to restore tmpfs mount {path}",
+                        timeout_duration=LONG_TIMEOUT,
+                    )
+                env.communicate(f"source {PATH_TO_SHELL_STATE} 2>/dev/null; rm {PATH_TO_SHELL_STATE}")
+                self.logger.info(f"🍴 Forked environment into container {env.container_name}")
+        except:
+            # No fork is handed to the caller, so the forks that were started and the image are removed here
+            for env in envs:
+                try:
+                    env.close()
+                except:
+                    pass
+            envs[0].remove_fork_image()
+            raise
+        return envs
+
     # MARK: Helper functions #
 
     def _reset_container(self) -> None:
@@ -375,8 +542,16 @@ class SWEEnv(gym.Env):
             image_name_sanitized = self.image_name.replace("/", "-")
             image_name_sanitized = image_name_sanitized.replace(":", "-")
             self.container_name = f"{image_name_sanitized}-{hash_object.hexdigest()[:10]}"
+        # Commands have to be installed in the shell of the new container
+        self.commands_fingerprint = None
+        volumes, environment = self._get_package_mirror_config()
         self.container, self.parent_pids = get_container(
-            self.container_name, self.image_name, persistent=self.persistent
+            self.container_name,
+            self.image_name,
+            persistent=self.persistent,
+            tmpfs=self._get_tmpfs_mounts(),
+            volumes=volumes,
+            environment=environment,
         )
         try:
             client = docker.from_env()
@@ -388,6 +563,62 @@ class SWEEnv(gym.Env):
         self.container_obj = client.containers.get(self.container_name)
         self.logger.info("🌱 Environment Initialized")
 
+    def _get_tmpfs_mounts(self) -> dict[str, str]:
+        """
+        Returns the tmpfs mounts (container path -> mount options) requested by the environment arguments.
+        A tmpfs hides the content of the image at its path: the workspace is seeded by `_seed_workspace`, conda
+        environments of the image cannot be copied to the same path and are created again by `install_env`.
+        """
+        mounts = {}
+        if self.args.workspace_tmpfs_size is not None:
+            mounts[PATH_TO_WORKSPACE] = f"rw,exec,size={self.args.workspace_tmpfs_size}"
+        if self.args.conda_tmpfs_size is not None:
+            mounts[PATH_TO_CONDA_ENVS] = f"rw,exec,size={self.args.conda_tmpfs_size}"
+        return mounts
+
+    def _get_package_mirror_config(self) -> Tuple[dict[str, str], dict[str, str]]:
+        """
+        Returns the volumes (host path -> container path) and environment variables that point pip and conda
+        inside the container at the local package mirror (if one is configured).
+        * pip uses `<mirror>/pip` as wheelhouse (`--find-links`)
+        * conda uses `<mirror>/conda` as read-only package cache after the package cache of the container, so
+          containers running in parallel do not extract packages into the shared mirror
+        """
+        if self.args.package_mirror is None:
+            if self.args.offline:
+                raise ValueError("offline=True requires a package_mirror")
+            return {}, {}
+        volumes = {os.path.abspath(self.args.package_mirror): f"{PATH_TO_PACKAGE_MIRROR}:ro"}
+        environment = {
+            "PIP_FIND_LINKS": f"{PATH_TO_PACKAGE_MIRROR}/pip",
+            "CONDA_PKGS_DIRS": f"/root/miniconda3/pkgs,{PATH_TO_PACKAGE_MIRROR}/conda",
+        }
+        if self.args.offline:
+            environment["PIP_NO_INDEX"] = "1"
+            environment["CONDA_OFFLINE"] = "true"
+        return volumes, environment
+
+    def _seed_workspace(self, repo_name: str) -> str:
+        """
+        Copies the cached checkout of a repository into the tmpfs workspace (if it is not there yet)
+        and evicts the checkouts of all other repositories to keep the tmpfs small.
+
+        Returns:
+            repo_path (`str`) - path of the working copy inside the tmpfs
+        """
+        repo_path = f"{PATH_TO_WORKSPACE}/{repo_name}"
+        self.communicate_with_handling(
+            input=f"find {PATH_TO_WORKSPACE} -mindepth 1 -maxdepth 1 ! -name {repo_name} -exec rm -rf {{}} +",
+            error_msg="Failed to clean up tmpfs workspace",
+            timeout_duration=LONG_TIMEOUT,
+        )
+        self.communicate_with_handling(
+            input=f"[ -d {repo_path} ] || cp -a /{repo_name} {repo_path}",
+            error_msg="Failed to copy repository to tmpfs workspace",
+            timeout_duration=LONG_TIMEOUT,
+        )
+        return repo_path
+
     def _init_scripts(self):
         """
         Initialize custom commands within container
@@ -516,13 +747,78 @@ class SWEEnv(gym.Env):
         Args:
             output (`str`) - `submit` observation
         Returns:
-            submission (`str`) - diff patch submission
+            submission (`str`) - diff patch submission (read from the artifacts directory if only a reference was printed)
         """
         pattern = r"\<\<SUBMISSION\|\|(.*)\|\|SUBMISSION\>\>"
         match = re.search(pattern, output, re.DOTALL)
         if match is None:
             return None
-        return match.group(1)
+        submission = match.group(1)
+        if submission.startswith(ARTIFACT_PREFIX):
+            return self.get_artifact(submission[len(ARTIFACT_PREFIX):].strip())
+        return submission
+
+    def get_artifact(self, name: str) -> str:
+        """
+        Retrieves an artifact that a command wrote to the artifacts directory of the container.
+        Artifacts are transferred with the Docker API instead of the shell session, so large outputs
+        do not need to pass through the observation.
+
+        Args:
+            name (`str`) - file name of the artifact
+        Returns:
+            contents (`str`) - contents of the artifact
+        """
+        return read_file_from_container(self.container_obj, f"{PATH_TO_ARTIFACTS}/{name}")
+
+    def get_workspace_patch(self) -> str:
+        """
+        Returns the changes of the repository against the base commit (including untracked files) as a binary patch.
+        A temporary index is used, so the index of the repository is not modified.
+
+        Returns:
+            patch (`str`) - changes against the base commit
+        """
+        return self.get_changed_workspace_patch(None)[0]
+
+    def get_changed_workspace_patch(self, previous_hash: Optional[str]) -> Tuple[Optional[str], str]:
+        """
+        Like `get_workspace_patch`, but the patch is only transferred from the container if its hash differs
+        from `previous_hash` (the hash returned by an earlier call).
+
+        Returns:
+            patch (`Optional[str]`) - changes against the base commit, None if unchanged
+            hash (`str`) - sha256 of the patch
+        """
+        index = f"GIT_INDEX_FILE={PATH_TO_CHECKPOINT_INDEX}"
+        output = self.communicate(
+            f'(cd "$ROOT" && cp "$(git rev-parse --git-dir)/index" {PATH_TO_CHECKPOINT_INDEX} && '
+            f"{index} git add -A && "
+            f"{index} git diff --cached --binary {self.base_commit} > {PATH_TO_ARTIFACTS}/checkpoint.patch; "
+            f"rc=$?; rm -f {PATH_TO_CHECKPOINT_INDEX}; "
+            f"[ $rc -eq 0 ] && sha256sum < {PATH_TO_ARTIFACTS}/checkpoint.patch | cut -d ' ' -f 1; exit $rc)"
+        )
+        if self.returncode != 0:
+            raise RuntimeError(f"Failed to get workspace patch: {output}")
+        patch_hash = output.strip()
+        if patch_hash == previous_hash:
+            return None, patch_hash
+        return self.get_artifact("checkpoint.patch"), patch_hash
+
+    def apply_workspace_patch(self, patch: str) -> None:
+        """
+        Applies a patch returned by `get_workspace_patch` to the repository (which has to be at the base commit)
+
+        Args:
+            patch (`str`) - changes against the base commit
+        """
+        if not patch.strip():
+            return
+        copy_file_to_container(self.container_obj, patch, PATH_TO_CHECKPOINT_PATCH)
+        self.communicate_with_handling(
+            f'(cd "$ROOT" && git apply --binary {PATH_TO_CHECKPOINT_PATCH}); rc=$?; rm -f {PATH_TO_CHECKPOINT_PATCH}; (exit $rc)',
+            error_msg="Failed to apply workspace patch",
+        )
 
     def install_env(self) -> None:
         """
@@ -617,6 +913,13 @@ class SWEEnv(gym.Env):
                     pre_install_cmd,
                     error_msg="Pre-install commands failed to execute successfully",
                 )
+        fingerprint = None
+        if self.args.skip_redundant_install:
+            fingerprint = self._get_install_fingerprint(install_configs)
+            if self._restore_install(fingerprint):
+                self.logger.info(f"Install fingerprint unchanged, skipping install of {repo_name}")
+                return
+            self.communicate(f"rm -f {PATH_TO_INSTALL_FINGERPRINT}")
         self.logger.info(f"Installing {repo_name} at base commit...")
         if "install" in install_configs:
             install_cmd = install_configs["install"]
@@ -632,11 +935,66 @@ class SWEEnv(gym.Env):
                     post_install_cmd,
                     error_msg="Post-install commands failed to execute successfully",
                 )
+        if fingerprint is not None:
+            self._save_install(fingerprint)
+
+    def _get_install_fingerprint(self, install_configs: dict) -> str:
+        """
+        Computes a hash of the install commands and of the build-relevant files of the repository
+        (as checked out at the base commit). Non-editable installs copy the whole package into the
+        conda environment, so in that case all tracked files are considered build-relevant.
+        """
+        install_cmd = install_configs.get("install", "")
+        if "-e " in install_cmd or "develop" in install_cmd:
+            # Pathspecs without a wildcard only match at the root, so match recursively
+            pathspecs = " ".join(f"':(glob)**/{pathspec}'" for pathspec in BUILD_FILES)
+            files_cmd = f"git ls-files -s -- {pathspecs} | sha256sum"
+        else:
+            files_cmd = "git rev-parse HEAD^{tree}"
+        files_hash = self.communicate_with_handling(
+            files_cmd,
+            error_msg="Failed to compute install fingerprint",
+        ).strip()
+        commands = json.dumps(
+            {key: install_configs.get(key) for key in ["pre_install", "install", "post_install"]},
+            sort_keys=True,
+        )
+        return hashlib.sha256(f"{commands}\n{files_hash}".encode()).hexdigest()
+
+    def _restore_install(self, fingerprint: str) -> bool:
+        """
+        Restores the build artifacts (untracked files, e.g. compiled extensions) of a previous install
+        with the same fingerprint into the repository. Returns False if there is no such install.
+        """
+        stored_fingerprint = self.communicate(f"cat {PATH_TO_INSTALL_FINGERPRINT} 2>/dev/null").strip()
+        if stored_fingerprint != fingerprint:
+            return False
+        self.communicate_with_handling(
+            f"tar -xf {PATH_TO_INSTALL_ARTIFACTS}",
+            error_msg="Failed to restore install artifacts",
+            timeout_duration=LONG_TIMEOUT,
+        )
+        return True
+
+    def _save_install(self, fingerprint: str) -> None:
+        """
+        Saves the build artifacts of the install (`git clean` removes them at the next reset) and its fingerprint
+        """
+        self.communicate_with_handling(
+            f"git ls-files --others -z | tar --null -T - -cf {PATH_TO_INSTALL_ARTIFACTS}"
+            f" && echo {fingerprint} > {PATH_TO_INSTALL_FINGERPRINT}",
+            error_msg="Failed to save install artifacts",
+            timeout_duration=LONG_TIMEOUT,
+        )
 
     def add_commands(self, commands: list[dict]) -> None:
         """
-        Adds custom commands to container
+        Adds custom commands to container (skipped if the same commands are already installed)
         """
+        fingerprint = hashlib.sha256(json.dumps(commands, sort_keys=True).encode()).hexdigest()
+        if fingerprint == self.commands_fingerprint:
+            self.logger.debug("Commands are already installed")
+            return
         for command in commands:
             name = command["name"]
             contents = command["contents"]
@@ -659,6 +1017,52 @@ class SWEEnv(gym.Env):
                 pass
             else:
                 raise ValueError(f"Invalid command type: {command['type']}")
+        self.commands_fingerprint = fingerprint
+
+    def snapshot_environment_vars(self, names: list[str]) -> dict:
+        """
+        Captures shell variables and the working directory with a single command
+
+        Args:
+            names (`list[str]`) - names of the shell variables to capture
+
+        Returns:
+            snapshot (`dict`) - `declare` statement per variable (None if unset) and working directory,
+                to be passed to `restore_environment_vars`
+        """
+        marker = "<<ENV_SNAPSHOT||{}||ENV_SNAPSHOT>>"
+        command = "\n".join(
+            [f"echo '{marker.format(name)}'; declare -p {name} 2>/dev/null" for name in names]
+            + [f"echo '{marker.format('')}'; pwd -P"]
+        )
+        output = self.communicate(command)
+        if self.returncode != 0:
+            raise RuntimeError(f"Failed to capture environment variables: {output}")
+        pattern = re.escape(marker).replace(r"\{\}", "(.*?)")
+        parts = re.split(f"^{pattern}$", output, flags=re.MULTILINE)
+        # parts: [output before the first marker, name, value, name, value, ...]
+        values = {name: value.strip("\n") for name, value in zip(parts[1::2], parts[2::2])}
+        cwd = values.pop("")
+        return {
+            "variables": {name: values.get(name) or None for name in names},
+            "cwd": cwd.strip(),
+        }
+
+    def restore_environment_vars(self, snapshot: dict, init_code: str = "") -> None:
+        """
+        Restores shell variables and working directory captured by `snapshot_environment_vars` with a single command
+
+        Args:
+            snapshot (`dict`) - output of `snapshot_environment_vars`
+            init_code (`str`) - bash code to run before restoring (e.g. to define functions)
+        """
+        commands = [init_code] if init_code else []
+        for name, declaration in snapshot["variables"].items():
+            commands.append(declaration if declaration is not None else f"unset {name}")
+        commands.append(f"cd {shlex.quote(snapshot['cwd'])}")
+        output = self.communicate("\n".join(commands))
+        if self.returncode != 0:
+            raise RuntimeError(f"Failed to restore environment variables: {output}")
 
     def interrupt(self):
         """
@@ -689,7 +1093,7 @@ class SWEEnv(gym.Env):
         branch_name = f"swe-agent-fix-#{issue.number}-" + str(random.random())[2:10]
 
         self.communicate_with_handling(
-            input=f"rm model.patch",
+            input=f"rm -f model.patch",
             error_msg="Failed to remove model patch",
             timeout_duration=10,
         )
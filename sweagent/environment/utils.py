@@ -17,7 +17,7 @@ from ghapi.all import GhApi
 from io import BytesIO
 from pathlib import Path
 from subprocess import PIPE, STDOUT
-from typing import Any, List, Tuple, Dict
+from typing import Any, List, Optional, Tuple, Dict
 
 LOGGER_NAME = "intercode"
 START_UP_DELAY = 5
@@ -86,6 +86,24 @@ def copy_file_to_container(container, contents, container_path):
             os.remove(temp_file_name)
 
 
+def read_file_from_container(container, container_path) -> str:
+    """
+    Reads a file from a Docker container via the Docker API (without passing it through the shell session).
+
+    Args:
+    - container: Docker SDK container object.
+    - container_path: The path of the file inside the container.
+
+    Returns:
+    - The contents of the file. Bytes that are not valid UTF-8 (e.g. of a patch that touches files in another
+      encoding) are replaced by backslash escapes.
+    """
+    stream, _ = container.get_archive(container_path)
+    with BytesIO(b"".join(stream)) as tar_stream:
+        with tarfile.open(fileobj=tar_stream, mode='r') as tar:
+            return tar.extractfile(tar.next()).read().decode('utf-8', errors='backslashreplace')
+
+
 def read_with_timeout(container, pid_func, timeout_duration):
     """
     Read data from a subprocess with a timeout.
@@ -158,7 +176,13 @@ def get_background_pids(container_obj):
     return bash_pids, other_pids
 
 
-def _get_non_persistent_container(ctr_name: str, image_name: str) -> Tuple[subprocess.Popen, set]:
+def _get_non_persistent_container(
+    ctr_name: str,
+    image_name: str,
+    tmpfs: Optional[Dict[str, str]] = None,
+    volumes: Optional[Dict[str, str]] = None,
+    environment: Optional[Dict[str, str]] = None,
+) -> Tuple[subprocess.Popen, set]:
     startup_cmd = [
         "docker",
         "run",
@@ -166,6 +190,14 @@ def _get_non_persistent_container(ctr_name: str, image_name: str) -> Tuple[subpr
         "--rm",
         "--name",
         ctr_name,
+    ]
+    for path, options in (tmpfs or {}).items():
+        startup_cmd += ["--tmpfs", f"{path}:{options}"]
+    for host_path, container_path in (volumes or {}).items():
+        startup_cmd += ["-v", f"{host_path}:{container_path}"]
+    for key, value in (environment or {}).items():
+        startup_cmd += ["-e", f"{key}={value}"]
+    startup_cmd += [
         image_name,
         "/bin/bash",
         "-l",
@@ -192,7 +224,14 @@ def _get_non_persistent_container(ctr_name: str, image_name: str) -> Tuple[subpr
     return container, {"1", }  # bash PID is always 1 for non-persistent containers
 
 
-def _get_persistent_container(ctr_name: str, image_name: str, persistent: bool = False) -> Tuple[subprocess.Popen, set]:
+def _get_persistent_container(
+    ctr_name: str,
+    image_name: str,
+    persistent: bool = False,
+    tmpfs: Optional[Dict[str, str]] = None,
+    volumes: Optional[Dict[str, str]] = None,
+    environment: Optional[Dict[str, str]] = None,
+) -> Tuple[subprocess.Popen, set]:
     client = docker.from_env()
     containers = client.containers.list(all=True, filters={"name": ctr_name})
     if ctr_name in [c.name for c in containers]:
@@ -216,6 +255,9 @@ def _get_persistent_container(ctr_name: str, image_name: str, persistent: bool =
             tty=True,
             detach=True,
             auto_remove=not persistent,
+            tmpfs=tmpfs or {},
+            volumes=[f"{host_path}:{container_path}" for host_path, container_path in (volumes or {}).items()],
+            environment=environment or {},
         )
         container_obj.start()
     startup_cmd =  [
@@ -256,7 +298,14 @@ def _get_persistent_container(ctr_name: str, image_name: str, persistent: bool =
     return container, set(map(str, [bash_pid, 1, ]))
 
 
-def get_container(ctr_name: str, image_name: str, persistent: bool = False) -> subprocess.Popen:
+def get_container(
+    ctr_name: str,
+    image_name: str,
+    persistent: bool = False,
+    tmpfs: Optional[Dict[str, str]] = None,
+    volumes: Optional[Dict[str, str]] = None,
+    environment: Optional[Dict[str, str]] = None,
+) -> subprocess.Popen:
     """
     Get a container object for a given container name and image name
 
@@ -264,13 +313,18 @@ def get_container(ctr_name: str, image_name: str, persistent: bool = False) -> s
         ctr_name (str): Name of container
         image_name (str): Name of image
         persistent (bool): Whether to use a persistent container or not
+        tmpfs (dict): Mapping of container paths to tmpfs mount options (e.g. "rw,exec,size=8g").
+            The mounts are discarded together with the container.
+        volumes (dict): Mapping of host paths to container paths to bind mount, a container path can end with
+            a mode (e.g. "/root/mirror:ro")
+        environment (dict): Environment variables to set in the container
     Returns:
         Container object
     """
     if persistent:
-        return _get_persistent_container(ctr_name, image_name)
+        return _get_persistent_container(ctr_name, image_name, tmpfs=tmpfs, volumes=volumes, environment=environment)
     else:
-        return _get_non_persistent_container(ctr_name, image_name)
+        return _get_non_persistent_container(ctr_name, image_name, tmpfs=tmpfs, volumes=volumes, environment=environment)
 
 
 def get_commit(api: GhApi, owner: str, repo: str, base_commit: str = None):
@@ -0,0 +1,65 @@
+import pytest
+
+from sweagent.agent.agents import Agent, LoopDetector
+from sweagent.agent.steps import BlockingCall, run_steps
+
+
+def test_dispatch_runs_steps_of_public_method():
+    agent = object.__new__(Agent)
+
+    def forward_model(observation, state):
+        response = yield "query"
+        return f"{observation} {response}"
+
+    agent._forward_model = forward_model
+    steps = agent._dispatch("forward_model", "obs", "{}")
+    assert next(steps) == "query"
+    with pytest.raises(StopIteration) as e:
+        steps.send("response")
+    assert e.value.value == "obs response"
+
+
+def test_dispatch_calls_overridden_public_method():
+    class CustomAgent(Agent):
+        def forward_model(self, observation, state):
+            return f"custom {observation}"
+
+    agent = object.__new__(CustomAgent)
+    assert isinstance(next(agent._dispatch("forward_model", "obs", "{}")), BlockingCall)
+    assert run_steps(agent._dispatch("forward_model", "obs", "{}")) == "custom obs"
+
+
+def test_loop_detector_repeated_step():
+    detector = LoopDetector(max_repeats=3, max_cycle_length=2)
+    assert detector.add("ls", "a.py") is None
+    # Trailing whitespace of the action does not matter
+    assert detector.add("ls\n", "a.py") is None
+    assert detector.add("ls", "a.py") == 1
+    # A loop has to be repeated from scratch to be detected again
+    assert detector.add("ls", "a.py") is None
+    assert detector.add("ls", "a.py") is None
+    assert detector.add("ls", "a.py") == 1
+
+
+def test_loop_detector_same_action_different_observation():
+    detector = LoopDetector(max_repeats=2, max_cycle_length=1)
+    assert detector.add("python test.py", "1 failed") is None
+    assert detector.add("python test.py", "0 failed") is None
+
+
+def test_loop_detector_cycle():
+    detector = LoopDetector(max_repeats=2, max_cycle_length=3)
+    steps = [("open a.py", "a"), ("open b.py", "b"), ("open a.py", "a")]
+    assert [detector.add(*step) for step in steps] == [None, None, None]
+    assert detector.add("open b.py", "b") == 2
+
+
+def test_loop_detector_cycle_longer_than_max():
+    detector = LoopDetector(max_repeats=2, max_cycle_length=2)
+    steps = [("a", "1"), ("b", "2"), ("c", "3")] * 3
+    assert all(detector.add(*step) is None for step in steps)
+
+
+def test_loop_detector_disabled():
+    detector = LoopDetector(max_repeats=0, max_cycle_length=2)
+    assert all(detector.add("ls", "a.py") is None for _ in range(10))
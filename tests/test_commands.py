@@ -0,0 +1,89 @@
+import re
+
+from types import SimpleNamespace
+
+import pytest
+
+from sweagent.agent.agents import Agent
+from sweagent.agent.commands import Command, CommandLexer
+
+EDIT_PATTERN = re.compile(r'^\s*(edit)\s*(.*?)^(end_of_edit)\s*$', re.DOTALL | re.MULTILINE)
+OPEN_PATTERN = re.compile(r'^\s*(open)\s*(.*?)$', re.MULTILINE)
+SUBMIT_PATTERN = re.compile(r'^\s*(submit)(\s*)$', re.MULTILINE)
+PATTERNS = [EDIT_PATTERN, OPEN_PATTERN, SUBMIT_PATTERN]
+
+
+def search_commands(patterns, action: str) -> list[tuple]:
+    """Reference: search the rest of the action with every pattern after each match (as before the lexer)"""
+    commands = list()
+    rem_action = action
+    while rem_action.strip():
+        matches = [match for match in (pat.search(rem_action) for pat in patterns) if match]
+        if not matches:
+            break
+        first_match = min(matches, key=lambda match: match.start())
+        commands.append((first_match.group(0).strip(), first_match.group(1), first_match.group(2)))
+        rem_action = rem_action[first_match.end():]
+    return commands
+
+
+@pytest.mark.parametrize("action", [
+    "ls -l",
+    "",
+    "open foo.py",
+    "ls\nopen foo.py\nsearch_file bar",
+    "edit 1:2\n    return 1\nend_of_edit",
+    "open foo.py\nedit 1:2\nopen = 1\nend_of_edit\nsubmit",
+    "edit 1:1\na\nend_of_edit\nedit 3:3\nb\nend_of_edit\n",
+    "  open foo.py  \n\nsubmit\n",
+])
+def test_lexer_matches_search_with_each_pattern(action):
+    # The search started each pattern at the end of the last match, so its matches could include the rest of that
+    # line. This only adds whitespace, which `split_actions` drops in between commands
+    commands = [
+        (match.group(0).strip(), match.group(1), match.group(2)) for match in CommandLexer(PATTERNS).finditer(action)
+    ]
+    assert commands == search_commands(PATTERNS, action)
+
+
+def test_lexer_groups_are_numbered_per_pattern():
+    match = next(CommandLexer(PATTERNS).finditer("ls\nedit 1:2\nfoo\nend_of_edit\n"))
+    assert match.group(1) == "edit"
+    assert match.group(2) == "1:2\nfoo\n"
+    assert match.group(3) == "end_of_edit"
+    assert match.start(1) == match.group(0).index("edit") + match.start()
+
+
+def test_lexer_ties_go_to_the_first_pattern():
+    specific = re.compile(r'^\s*(open)\s+(foo)\S*$', re.MULTILINE)
+    assert next(CommandLexer([specific, OPEN_PATTERN]).finditer("open foo.py")).group(2) == "foo"
+    assert next(CommandLexer([OPEN_PATTERN, specific]).finditer("open foo.py")).group(2) == "foo.py"
+
+
+def test_lexer_without_patterns_matches_nothing():
+    assert list(CommandLexer([]).finditer("open foo.py")) == []
+
+
+def make_agent() -> Agent:
+    agent = object.__new__(Agent)
+    agent.name = "primary"
+    agent.config = SimpleNamespace(
+        _commands=[Command(code="", name="edit", end_name="end_of_edit"), Command(code="", name="open")],
+        _subroutines={},
+        submit_command="submit",
+        multi_line_command_endings={"edit": "end_of_edit"},
+    )
+    agent._parse_command_patterns()
+    return agent
+
+
+def test_split_actions_keeps_text_around_commands():
+    action = "ls\nsubmit\necho done"
+    assert [sub_action["action"].strip() for sub_action in make_agent().split_actions(action)] == [
+        "ls", "submit", "echo done",
+    ]
+
+
+def test_guard_multiline_input_adds_heredoc_after_preceding_text():
+    action = "ls\nedit 1:2\nfoo\nend_of_edit\necho done"
+    assert make_agent()._guard_multiline_input(action) == "ls\n\nedit 1:2 << 'end_of_edit'\nfoo\nend_of_edit\n\necho done"
@@ -0,0 +1,24 @@
+import io
+import tarfile
+
+from sweagent.environment.utils import read_file_from_container
+
+
+class FakeContainer:
+    def __init__(self, content: bytes):
+        self.archive = io.BytesIO()
+        with tarfile.open(fileobj=self.archive, mode="w") as tar:
+            info = tarfile.TarInfo("file")
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+    def get_archive(self, path):
+        return [self.archive.getvalue()], {}
+
+
+def test_read_file_from_container():
+    assert read_file_from_container(FakeContainer("+café\n".encode()), "/file") == "+café\n"
+
+
+def test_read_file_from_container_escapes_invalid_utf8():
+    assert read_file_from_container(FakeContainer(b"+caf\xe9\n"), "/file") == "+caf\\xe9\n"
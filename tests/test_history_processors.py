@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import pytest
+
+from sweagent.agent.agents import Agent
+from sweagent.agent.history_processors import HistoryProcessor, ProcessedHistory, TokenBudgetHistoryProcessor
+from sweagent.agent.tokens import FunctionTokenCounter
+
+
+def make_history(n_observations: int, lines: int = 10) -> list[dict]:
+    history = [
+        {"role": "system", "content": "system", "agent": "primary"},
+        {"role": "user", "content": "issue", "agent": "primary"},
+    ]
+    for i in range(n_observations):
+        history.append({"role": "assistant", "content": f"action {i}", "agent": "primary"})
+        history.append({"role": "user", "content": "\n".join(["output"] * lines), "agent": "primary"})
+    return history
+
+
+def make_model(max_context: int):
+    # One token per character, no message overhead
+    return SimpleNamespace(
+        model_metadata={"max_context": max_context},
+        token_counter=FunctionTokenCounter(len, tokens_per_message=0),
+    )
+
+
+def test_token_budget_uses_model_of_each_agent():
+    processor = TokenBudgetHistoryProcessor(reserved_output_tokens=0)
+    history = make_history(3)
+    small = processor.update(history, ProcessedHistory(model=make_model(200)))
+    large = processor.update(history, ProcessedHistory(model=make_model(10_000)))
+    assert small[3]["content"] == "Old output omitted (10 lines)"
+    assert small[-1] == history[-1]
+    assert large == history
+    # The processor itself is not bound to either model
+    assert processor.max_context is None
+
+
+def test_token_budget_incremental_equals_full_processing():
+    processor = TokenBudgetHistoryProcessor(reserved_output_tokens=0)
+    history = make_history(6)
+    processed = ProcessedHistory(model=make_model(300))
+    for n in range(1, len(history) + 1):
+        incremental = list(processor.update(history[:n], processed))
+        assert incremental == processor.update(history[:n], ProcessedHistory(model=make_model(300)))
+    assert sum(len(entry["content"]) for entry in incremental) <= 300
+
+
+def window(file: str, start: int) -> str:
+    lines = "\n".join(f"{i}:line {i}" for i in range(start, start + 3))
+    return f"[File: {file} (100 lines total)]\n{lines}\n(97 more lines below)"
+
+
+WINDOW_HISTORY = [
+    {"role": "system", "content": "system", "agent": "primary"},
+    {"role": "user", "content": "demo", "agent": "primary", "is_demo": True},
+    {"role": "user", "content": "issue", "agent": "primary"},
+    {"role": "assistant", "content": "open a.py", "agent": "primary"},
+    {"role": "user", "content": window("/a.py", 1), "agent": "primary"},
+    {"role": "assistant", "content": "open b.py", "agent": "primary"},
+    {"role": "user", "content": window("/b.py", 1), "agent": "primary"},
+    {"role": "assistant", "content": "scroll_down", "agent": "primary"},
+    {"role": "user", "content": window("/a.py", 4), "agent": "primary"},
+    {"role": "assistant", "content": "ls", "agent": "primary"},
+    {"role": "user", "content": "a.py b.py", "agent": "primary"},
+    {"role": "assistant", "content": "scroll_down", "agent": "primary"},
+    {"role": "user", "content": window("/a.py", 7), "agent": "primary"},
+]
+
+
+@pytest.mark.parametrize("name, args", [
+    ("DefaultHistoryProcessor", {}),
+    ("LastNObservations", {"n": 3}),
+    ("Last2Observations", {}),
+    ("Last5Observations", {}),
+    ("ClosedWindowHistoryProcessor", {}),
+])
+def test_incremental_update_equals_full_processing(name, args):
+    processor = HistoryProcessor.get(name, **args)
+    processed = ProcessedHistory()
+    for n in range(1, len(WINDOW_HISTORY) + 1):
+        history = WINDOW_HISTORY[:n]
+        assert list(processor.update(history, processed)) == processor(history)
+
+
+def test_closed_window_keeps_only_the_last_window_of_each_file():
+    processed = HistoryProcessor.get("ClosedWindowHistoryProcessor")(WINDOW_HISTORY)
+    assert processed[4]["content"].startswith("[File: /a.py (100 lines total)]\nOutdated window with 3 lines omitted...")
+    assert processed[6] == WINDOW_HISTORY[6]
+    assert processed[8]["content"] != WINDOW_HISTORY[8]["content"]
+    assert processed[-1] == WINDOW_HISTORY[-1]
+    # The history is not modified
+    assert WINDOW_HISTORY[4]["content"] == window("/a.py", 1)
+
+
+def test_local_history_is_filtered_and_processed_incrementally():
+    agent = object.__new__(Agent)
+    agent.name = "primary"
+    agent.model = None
+    agent.config = SimpleNamespace(history_processor=HistoryProcessor.get("LastNObservations", n=2))
+    agent.history = []
+    agent._reset_local_history()
+    for entry in WINDOW_HISTORY:
+        agent.history.append(entry)
+        agent.history.append({"role": "user", "content": "subroutine", "agent": "edit_agent"})
+        assert agent.local_history == agent.config.history_processor(agent.history[::2])
+    # A replaced history is processed from scratch
+    agent.history = WINDOW_HISTORY[:3]
+    assert agent.local_history == WINDOW_HISTORY[:3]
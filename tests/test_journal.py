@@ -0,0 +1,106 @@
+import json
+
+from sweagent.agent.journal import TrajectoryJournal, load_checkpoint, load_journal, load_trajectory
+
+
+def step(i):
+    return {"action": f"action {i}", "observation": f"observation {i}", "response": f"response {i}"}
+
+
+def message(i):
+    return {"role": "assistant", "content": f"response {i}", "agent": "primary"}
+
+
+def write_journal(traj_path, n_steps, fsync_every=0):
+    journal = TrajectoryJournal(traj_path, environment="swe_main", fsync_every=fsync_every)
+    history, trajectory = [{"role": "system", "content": "system", "agent": "primary"}], []
+    for i in range(n_steps):
+        history.append(message(i))
+        trajectory.append(step(i))
+        journal.append(history, trajectory, {"step": i})
+    return journal, history, trajectory
+
+
+def test_journal_round_trip(tmp_path):
+    journal, history, trajectory = write_journal(tmp_path / "instance.traj", n_steps=3, fsync_every=2)
+    assert journal.path == tmp_path / "instance.journal"
+    content = load_journal(journal.path)
+    assert content == {"environment": "swe_main", "history": history, "trajectory": trajectory, "info": {"step": 2}}
+
+
+def test_journal_records_only_new_entries(tmp_path):
+    journal, _, _ = write_journal(tmp_path / "instance.traj", n_steps=3)
+    records = [json.loads(line) for line in journal.path.read_text().splitlines()]
+    assert len(records) == 4
+    assert [len(record["trajectory"]) for record in records[1:]] == [1, 1, 1]
+    assert records[2]["history"] == [message(1)]
+
+
+def test_journal_ignores_partial_last_record(tmp_path):
+    journal, history, trajectory = write_journal(tmp_path / "instance.traj", n_steps=2)
+    with journal.path.open("a") as f:
+        f.write('{"history": [{"role": "assistant", "cont')
+    content = load_journal(journal.path)
+    assert content["history"] == history
+    assert content["trajectory"] == trajectory
+    assert content["info"] == {"step": 1}
+
+
+def test_load_trajectory_prefers_traj_file(tmp_path):
+    traj_path = tmp_path / "instance.traj"
+    journal, history, trajectory = write_journal(traj_path, n_steps=2)
+    # Unfinished episode: only the journal exists
+    assert load_trajectory(traj_path)["trajectory"] == trajectory
+    assert load_trajectory(journal.path)["trajectory"] == trajectory
+    # Finished episode: the journal is replaced by the trajectory file
+    traj_path.write_text(json.dumps({"environment": "swe_main", "trajectory": [step(0)], "history": [], "info": {}}))
+    journal.remove()
+    assert not journal.path.exists()
+    assert load_trajectory(traj_path)["trajectory"] == [step(0)]
+    # The journal was listed before the episode finished
+    assert load_trajectory(journal.path)["trajectory"] == [step(0)]
+
+
+def checkpoint(i, patch=None):
+    checkpoint = {"patch_hash": f"hash {i}", "environment": {"CURRENT_FILE": f"file {i}"}, "observation": f"observation {i}"}
+    if patch is not None:
+        checkpoint["patch"] = patch
+    return checkpoint
+
+
+def test_load_checkpoint_without_checkpoints(tmp_path):
+    journal, _, _ = write_journal(tmp_path / "instance.traj", n_steps=2)
+    assert load_checkpoint(journal.path) is None
+
+
+def test_checkpoint_round_trip(tmp_path):
+    journal = TrajectoryJournal(tmp_path / "instance.traj", environment="swe_main")
+    history, trajectory = [], []
+    # The patch is only included when it changed (step 1 and 2 keep the patch of step 0)
+    for i, ckpt in enumerate([checkpoint(0, patch="patch 0"), checkpoint(1), checkpoint(2)]):
+        history.append(message(i))
+        trajectory.append(step(i))
+        journal.append(history, trajectory, {"step": i}, checkpoint=ckpt)
+    # Steps after the last checkpoint are dropped
+    history.append(message(3))
+    trajectory.append(step(3))
+    journal.append(history, trajectory, {"step": 3})
+    with journal.path.open("a") as f:
+        f.write('{"history": [], "trajectory": [], "info": {"step": 4}, "checkpoint": {"pat')
+    content = load_checkpoint(journal.path)
+    assert content["environment"] == "swe_main"
+    assert content["history"] == history[:3]
+    assert content["trajectory"] == trajectory[:3]
+    assert content["info"] == {"step": 2}
+    assert content["checkpoint"] == {**checkpoint(2), "patch": "patch 0"}
+
+
+def test_checkpoint_with_emptied_patch(tmp_path):
+    journal = TrajectoryJournal(tmp_path / "instance.traj", environment="swe_main")
+    history, trajectory = [], []
+    for i, ckpt in enumerate([checkpoint(0, patch="patch 0"), checkpoint(1, patch="")]):
+        history.append(message(i))
+        trajectory.append(step(i))
+        journal.append(history, trajectory, {"step": i}, checkpoint=ckpt)
+    # A reverted change is an empty patch, not a missing one
+    assert load_checkpoint(journal.path)["checkpoint"]["patch"] == ""
@@ -0,0 +1,46 @@
+import pytest
+
+import make_package_mirror
+from make_package_mirror import get_mirror_script, get_pip_requirements
+
+ENVIRONMENT_YML = """\
+name: package_mirror
+dependencies:
+  - python=3.9
+  - numpy=1.24
+  - pip
+  - pip:
+    - pytest==7.4.0
+    - hypothesis
+"""
+
+RECORD = {"repo": "owner/repo", "version": "1.0", "base_commit": "0123abc"}
+
+
+@pytest.fixture
+def install_configs(monkeypatch):
+    configs = {"python": "3.9", "install": "pip install -e ."}
+    monkeypatch.setattr(make_package_mirror, "MAP_VERSION_TO_INSTALL", {"owner/repo": {"1.0": configs}})
+    monkeypatch.setattr(make_package_mirror, "get_environment_yml", lambda record, env_name: ENVIRONMENT_YML)
+    monkeypatch.setattr(make_package_mirror, "get_requirements", lambda record: "requests==2.31.0")
+    return configs
+
+
+def test_get_pip_requirements():
+    assert get_pip_requirements(ENVIRONMENT_YML) == ["pytest==7.4.0", "hypothesis"]
+
+
+@pytest.mark.parametrize("packages, downloaded", [
+    ("requirements.txt", ["requests==2.31.0"]),
+    ("environment.yml", ["pytest==7.4.0", "hypothesis"]),
+    ("numpy scipy", []),
+])
+def test_offline_install_requirements_are_mirrored(install_configs, packages, downloaded):
+    """Every install type downloads its pip packages and the build requirements of the repository"""
+    install_configs["packages"] = packages
+    script = get_mirror_script(RECORD, include_repo_dependencies=False)
+    for requirement in downloaded:
+        assert requirement in script
+    assert "pip download -d /root/package_mirror/pip -r" in script or not downloaded
+    assert "https://raw.githubusercontent.com/owner/repo/0123abc/pyproject.toml" in script
+    assert "pip download -d /root/package_mirror/pip flake8 setuptools wheel" in script
@@ -0,0 +1,75 @@
+import pytest
+
+from sweagent.agent.models import MergedMessageCache, MessageCache
+
+
+def convert(entry):
+    # Entries of other agents are not sent
+    if entry.get("agent") == "other":
+        return None
+    return {"role": entry["role"], "content": entry["content"]}
+
+
+def merge(history):
+    """Reference: convert and combine all entries from scratch"""
+    merged = []
+    for entry in history:
+        message = convert(entry)
+        if message is None:
+            continue
+        if merged and merged[-1]["role"] == message["role"]:
+            merged[-1] = {**merged[-1], "content": merged[-1]["content"] + "\n" + message["content"]}
+        else:
+            merged.append(message)
+    return merged
+
+
+def entry(role, content, agent="primary"):
+    return {"role": role, "content": content, "agent": agent}
+
+
+HISTORY = [
+    entry("system", "system"),
+    entry("user", "demo"),
+    entry("user", "issue"),
+    entry("assistant", "ls"),
+    entry("user", "a.py"),
+    entry("user", "hidden", agent="other"),
+    entry("user", "note"),
+    entry("assistant", "open a.py"),
+    entry("user", "window"),
+]
+
+
+def test_message_cache_only_converts_new_and_replaced_entries():
+    converted = []
+
+    def counting_convert(entry):
+        converted.append(entry["content"])
+        return convert(entry)
+
+    cache = MessageCache()
+    cache.get_messages(HISTORY[:4], counting_convert)
+    history = HISTORY[:3] + [entry("assistant", "ls -a")] + HISTORY[4:6]
+    assert cache.update(history, counting_convert) == 3
+    assert converted == ["system", "demo", "issue", "ls", "ls -a", "a.py", "hidden"]
+
+
+def test_merged_message_cache_equals_merging_from_scratch():
+    cache = MergedMessageCache()
+    for n in range(1, len(HISTORY) + 1):
+        assert cache.get_messages(HISTORY[:n], convert) == merge(HISTORY[:n])
+    # An entry in the middle of a combined message is replaced (e.g. by a history processor)
+    history = HISTORY[:4] + [entry("user", "omitted")] + HISTORY[5:]
+    assert cache.get_messages(history, convert) == merge(history)
+    # The history is truncated within a combined message
+    assert cache.get_messages(history[:6], convert) == merge(history[:6])
+    assert cache.get_messages(history[:2], convert) == merge(history[:2])
+
+
+@pytest.mark.parametrize("position, n_messages", [(0, 0), (1, 1), (2, 1), (3, 2), (4, 3), (6, 3), (7, 4), (8, 5), (9, 6)])
+def test_n_messages_before(position, n_messages):
+    cache = MergedMessageCache()
+    # system | demo+issue | ls | a.py+note | open a.py | window
+    cache.get_messages(HISTORY, convert)
+    assert cache.n_messages_before(position) == n_messages
@@ -0,0 +1,39 @@
+import pytest
+
+from sweagent.agent.models import ResponseStream
+from sweagent.agent.parsing import ThoughtActionParser, XMLCommandStream, XMLThoughtActionParser
+
+
+def stream_response(parse_function, response: str, chunk_size: int = 3) -> str:
+    """Feed `response` in chunks like a streamed model response, returns the text read until the stream closed"""
+    stream = ResponseStream(parse_function, [])
+    for start in range(0, len(response), chunk_size):
+        if stream.add(response[start:start + chunk_size]):
+            break
+    return stream.text
+
+
+def test_streamed_action_equals_full_parse():
+    parse_function = ThoughtActionParser()
+    response = "The test fails with\n```\nTypeError: bad\n```\nLet's open the file.\n```\nopen foo.py\n```\n"
+    streamed = stream_response(parse_function, response)
+    assert streamed == response
+    assert parse_function(streamed, []) == parse_function(response, [])
+    assert parse_function(streamed, [])[1].strip() == "open foo.py"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 100])
+def test_xml_stream_ends_after_first_command(chunk_size):
+    parse_function = XMLThoughtActionParser()
+    first = "Let's open the file.\n<command>\nopen foo.py\n</command>"
+    response = first + "\nThen\n<command>\nls\n</command>\n"
+    streamed = stream_response(parse_function, response, chunk_size)
+    assert streamed == first
+    assert parse_function(streamed, []) == parse_function(first, [])
+
+
+def test_xml_stream_ignores_close_tag_before_open_tag():
+    stream = XMLCommandStream()
+    assert stream.feed("The </command> tag closes a block. ") is None
+    assert stream.feed("<command>\nls\n</comm") is None
+    assert stream.feed("and> and more") == len(stream.text) - len(" and more")
@@ -0,0 +1,74 @@
+import logging
+
+import pytest
+
+from sweagent.agent import rate_limits
+from sweagent.agent.rate_limits import RateLimiter, get_rate_limiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limits.time, "time", clock)
+    return clock
+
+
+@pytest.mark.parametrize("state_path", [None, "state.json"])
+def test_requests_wait_for_the_bucket_to_refill(clock, tmp_path, state_path):
+    limiter = RateLimiter(requests_per_minute=2, state_path=tmp_path / state_path if state_path else None)
+    assert limiter.reserve(0) == 0
+    assert limiter.reserve(0) == 0
+    # The third request waits for half a minute (one request), the fourth one for a minute
+    assert limiter.reserve(0) == pytest.approx(30)
+    assert limiter.reserve(0) == pytest.approx(60)
+    clock.now += 60
+    assert limiter.reserve(0) == pytest.approx(30)
+
+
+def test_tokens_refill_with_time(clock):
+    limiter = RateLimiter(tokens_per_minute=1000)
+    assert limiter.reserve(800) == 0
+    assert limiter.reserve(400) == pytest.approx(12)
+    clock.now += 30
+    # The bucket is back at 300 tokens
+    assert limiter.reserve(300) == 0
+    assert limiter.reserve(100) == pytest.approx(6)
+
+
+def test_request_larger_than_the_limit_waits_for_a_full_bucket(clock):
+    limiter = RateLimiter(tokens_per_minute=1000)
+    limiter.consume(1000)
+    assert limiter.reserve(5000) == pytest.approx(60)
+
+
+def test_pause_holds_back_all_requests(clock):
+    limiter = RateLimiter(requests_per_minute=100)
+    limiter.pause(20)
+    assert limiter.reserve(0) == pytest.approx(20)
+    clock.now += 15
+    assert limiter.reserve(0) == pytest.approx(5)
+
+
+def test_state_file_is_shared(clock, tmp_path):
+    first = RateLimiter(requests_per_minute=1, state_path=tmp_path / "state.json")
+    second = RateLimiter(requests_per_minute=1, state_path=tmp_path / "state.json")
+    assert first.reserve(0) == 0
+    assert second.reserve(0) == pytest.approx(60)
+
+
+def test_get_rate_limiter_warns_about_other_limits(caplog):
+    limiter = get_rate_limiter("test:shared", requests_per_minute=10)
+    with caplog.at_level(logging.WARNING, logger="api_models"):
+        assert get_rate_limiter("test:shared", requests_per_minute=10) is limiter
+        assert not caplog.records
+        assert get_rate_limiter("test:shared", requests_per_minute=20) is limiter
+    assert "already limits to 10 requests" in caplog.text
+    assert limiter.requests_per_minute == 10
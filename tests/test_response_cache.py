@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+from sweagent.agent.response_cache import ResponseCache, cached_response
+
+
+class FakeModel:
+    api_model = "fake"
+    model_metadata = {}
+
+    def __init__(self, response_cache, temperature: float, response_cache_sampled: bool = False):
+        self.response_cache = response_cache
+        self.args = SimpleNamespace(temperature=temperature, top_p=1.0, response_cache_sampled=response_cache_sampled)
+        self.stats = SimpleNamespace(instance_cost=0.0, response_cache_hits=0, response_cache_saved_cost=0.0)
+        self.n_queries = 0
+
+    @cached_response
+    def query(self, history):
+        self.n_queries += 1
+        self.stats.instance_cost += 0.5
+        return f"response {self.n_queries}"
+
+
+HISTORY = [{"role": "user", "content": "hi", "agent": "primary"}]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(tmp_path / "cache.db", max_size=1024)
+
+
+def test_cached_response_at_temperature_zero(cache):
+    model = FakeModel(cache, temperature=0.0)
+    assert model.query(HISTORY) == "response 1"
+    assert model.query(HISTORY) == "response 1"
+    assert model.n_queries == 1
+    assert model.stats.response_cache_hits == 1
+    assert model.stats.response_cache_saved_cost == 0.5
+
+
+def test_sampled_responses_are_not_cached_by_default(cache):
+    model = FakeModel(cache, temperature=0.7)
+    assert model.query(HISTORY) == "response 1"
+    assert model.query(HISTORY) == "response 2"
+    assert model.stats.response_cache_hits == 0
+
+
+def test_sampled_responses_are_cached_with_opt_in(cache):
+    model = FakeModel(cache, temperature=0.7, response_cache_sampled=True)
+    model.query(HISTORY)
+    assert model.query(HISTORY) == "response 1"
+    assert model.n_queries == 1
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.db", max_size=10)
+    cache.put("a", "12345", 0.0)
+    cache.put("b", "12345", 0.0)
+    assert cache.get("a") is not None
+    cache.put("c", "12345", 0.0)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
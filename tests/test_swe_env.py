@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import pytest
+
+from sweagent.environment.swe_env import PATH_TO_PACKAGE_MIRROR, SWEEnv
+
+
+def make_env(**args) -> SWEEnv:
+    env = object.__new__(SWEEnv)
+    env.args = SimpleNamespace(**{"package_mirror": None, "offline": False, **args})
+    return env
+
+
+def test_package_mirror_is_mounted_read_only_after_the_container_cache(tmp_path):
+    volumes, environment = make_env(package_mirror=str(tmp_path))._get_package_mirror_config()
+    assert volumes == {str(tmp_path): f"{PATH_TO_PACKAGE_MIRROR}:ro"}
+    assert environment["CONDA_PKGS_DIRS"].split(",") == ["/root/miniconda3/pkgs", f"{PATH_TO_PACKAGE_MIRROR}/conda"]
+    assert "PIP_NO_INDEX" not in environment
+
+
+def test_offline_requires_package_mirror():
+    with pytest.raises(ValueError):
+        make_env(offline=True)._get_package_mirror_config()
+
+
+def test_fork_many_removes_forks_and_image_on_failure(monkeypatch):
+    env = make_env()
+    env.logger = SimpleNamespace(info=lambda *args: None)
+    env.container_name = "parent"
+    env.communicate = lambda *args, **kwargs: ""
+    env.communicate_with_handling = lambda *args, **kwargs: ""
+    env.container_obj = SimpleNamespace(commit=lambda: SimpleNamespace(id="sha256:fork"))
+    n_started = []
+
+    def init_container(self):
+        if len(n_started) == 1:
+            raise RuntimeError("Failed to start container")
+        n_started.append(self)
+
+    closed, removed = [], []
+    monkeypatch.setattr(SWEEnv, "_get_tmpfs_mounts", lambda self: {})
+    monkeypatch.setattr(SWEEnv, "_init_container", init_container)
+    monkeypatch.setattr(SWEEnv, "_init_scripts", lambda self: None)
+    monkeypatch.setattr(SWEEnv, "close", lambda self: closed.append(self))
+    monkeypatch.setattr(SWEEnv, "remove_fork_image", lambda self: removed.append(self.image_name))
+    with pytest.raises(RuntimeError):
+        env.fork_many(3)
+    assert len(closed) == 2
+    assert removed == ["sha256:fork"]
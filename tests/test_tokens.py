@@ -0,0 +1,107 @@
+import pytest
+
+from sweagent.agent.models import BaseModel, ContextWindowExceededError, CostLimitExceededError, ModelArguments
+from sweagent.agent.tokens import FunctionTokenCounter, TokenCounter
+
+
+class CountingTokenCounter(FunctionTokenCounter):
+    def __init__(self):
+        super().__init__(self.count_words, tokens_per_message=1)
+        self.counted = []
+
+    def count_words(self, text):
+        self.counted.append(text)
+        return len(text.split())
+
+
+def test_token_counter_estimates_from_characters():
+    counter = TokenCounter()
+    assert counter.count("") == 1
+    assert counter.count("a" * 40) == 11
+    assert counter.count_entry({"role": "user", "content": "a" * 40}) == 11 + TokenCounter.tokens_per_message
+
+
+def test_count_history_only_counts_new_and_replaced_entries():
+    counter = CountingTokenCounter()
+    history = [{"role": "system", "content": "one two"}, {"role": "user", "content": "three"}]
+    assert counter.count_history(history) == 2 + 1 + 1 + 1
+    history.append({"role": "assistant", "content": "four five six"})
+    assert counter.count_history(history) == 5 + 3 + 1
+    # Replaced entries (e.g. by history processors) are counted again, equal copies are not reused
+    history[1] = {"role": "user", "content": "three"}
+    assert counter.count_history(history) == 9
+    # Truncated history
+    assert counter.count_history(history[:1]) == 3
+    assert counter.counted == ["one two", "three", "four five six", "three"]
+
+
+def test_fresh_copy_keeps_tokenizer_and_drops_cache():
+    counter = CountingTokenCounter()
+    history = [{"role": "user", "content": "one two"}]
+    counter.count_history(history)
+    copied = counter.fresh_copy()
+    assert copied.count_function == counter.count_function
+    assert copied.tokens_per_message == 1
+    assert copied.count_history([{"role": "user", "content": "three"}]) == 2
+    # The cache of the original is untouched
+    assert counter.count_history(history) == 3
+    assert counter.counted == ["one two", "three"]
+
+
+class PreflightModel(BaseModel):
+    MODELS = {
+        "preflight": {
+            "max_context": 100,
+            "cost_per_input_token": 1e-02,
+            "cost_per_output_token": 1e-02,
+        },
+    }
+
+
+def get_model(**kwargs):
+    model = PreflightModel(ModelArguments(model_name="preflight", **kwargs), [])
+    model.token_counter = CountingTokenCounter()
+    return model
+
+
+def history_of(n_tokens):
+    # One token per message plus one token per word
+    return [{"role": "user", "content": " ".join(["word"] * (n_tokens - 1))}]
+
+
+def test_preflight_accepts_prompt_within_margin():
+    model = get_model()
+    model.token_counter.error_margin = 0.1
+    model.preflight(history_of(100))
+    # Within the error margin of the local count, the query is still sent
+    model.preflight(history_of(110))
+
+
+def test_preflight_rejects_prompt_exceeding_context_window():
+    model = get_model()
+    model.token_counter.error_margin = 0.1
+    with pytest.raises(ContextWindowExceededError):
+        model.preflight(history_of(113))
+
+
+def test_preflight_rejects_prompt_exceeding_cost_limit():
+    model = get_model(per_instance_cost_limit=1.0)
+    model.token_counter.error_margin = 0.0
+    model.stats.instance_cost = 0.5
+    model.preflight(history_of(40))
+    with pytest.raises(CostLimitExceededError):
+        model.preflight(history_of(50))
+
+
+def test_preflight_rejects_prompt_exceeding_total_cost_limit():
+    model = get_model(total_cost_limit=2.0)
+    model.token_counter.error_margin = 0.0
+    model.stats.total_cost = 1.5
+    with pytest.raises(CostLimitExceededError):
+        model.preflight(history_of(50))
+
+
+def test_preflight_without_metadata():
+    model = get_model()
+    model.model_metadata = {}
+    model.preflight(history_of(1000))